@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks importing synthetic delicious exports into a local fake FluidDB.
+
+For each export size a file in the same format as bookmarks.xml is generated
+and imported by a fresh Python process so the figures for one size don't
+affect another. The parse time, peak memory, requests issued (by endpoint)
+and end-to-end import time are reported as JSON, along with how long it takes
+a fresh process to import delicious2fluid, so results can be compared across
+versions:
+
+    $ python bench.py --sizes 1000,10000,100000 --workers 8 > results.json
+
+The fake FluidDB (see fakefluiddb.py) can be made to respond slowly or fail
+some requests with --latency and --error-rate.
+"""
+
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from optparse import OptionParser
+from xml.sax.saxutils import quoteattr
+
+import delicious2fluid
+from delicious2fluid import peakMemory
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def generateExport(path, count, tagCount=200, tagSetCount=100, tagsPerPost=3,
+    seed=0):
+    """
+    Writes a synthetic delicious export containing count posts to path. Like
+    real accounts, posts share a limited number (tagSetCount) of different
+    sets of tagsPerPost tags picked from tagCount distinct tags.
+    """
+    generator = random.Random(seed)
+    tags = ['tag%d' % i for i in range(tagCount)]
+    tagSets = [' '.join(generator.sample(tags, tagsPerPost))
+        for i in range(tagSetCount)]
+    export = open(path, 'w')
+    export.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    export.write('<posts user="bench" update="2010-08-26T10:25:02Z" tag=""'
+        ' total="%d">\n' % count)
+    for i in xrange(count):
+        hash = '%032x' % generator.getrandbits(128)
+        export.write('  <post href=%s hash="%s" description=%s tag=%s'
+            ' time="2010-06-17T16:20:18Z" extended="" meta="%032x" />\n' % (
+            quoteattr('http://example.com/%d' % i), hash,
+            quoteattr('Bookmark number %d' % i),
+            quoteattr(generator.choice(tagSets)),
+            generator.getrandbits(128)))
+    export.write('</posts>\n')
+    export.close()
+
+
+def serverStats(url):
+    """
+    Returns the request statistics from the fake FluidDB at url.
+    """
+    return json.load(urllib2.urlopen(url + '/_stats'))
+
+
+def runOne(path, url, root, workers=1, batchSize=1, profile=None):
+    """
+    Parses and then imports the export at path into the fake FluidDB at url
+    under the root namespace. Returns a dict of the measurements. If profile
+    is a directory the phases of the import are profiled into it.
+    """
+    result = {'memoryBeforeKB': peakMemory()}
+    # parse on its own
+    tags = set()
+    start = time.time()
+    export = open(path, 'r')
+    posts = 0
+    for obj in delicious2fluid.iterParseXml(export, tags):
+        posts += 1
+    export.close()
+    result['parseSeconds'] = time.time() - start
+    result['posts'] = posts
+    result['tags'] = len(tags)
+    result['parsePeakMemoryKB'] = peakMemory()
+    # then parse and import end to end
+    if profile:
+        delicious2fluid.profiler = delicious2fluid.Profiler(profile)
+    delicious2fluid.instance = url
+    before = serverStats(url)
+    start = time.time()
+    export = open(path, 'r')
+    tags = set()
+    delicious2fluid.importIntoFluidDB(tags,
+        delicious2fluid.iterParseXml(export, tags), 'bench', 'bench', root,
+        workers=workers, batchSize=batchSize)
+    export.close()
+    result['importSeconds'] = time.time() - start
+    result['objectsPerSecond'] = posts / max(result['importSeconds'], 0.001)
+    result['peakMemoryKB'] = peakMemory()
+    after = serverStats(url)
+    requests = after['requests']
+    for key, count in before['requests'].iteritems():
+        requests[key] -= count
+    result['requests'] = dict((key, count)
+        for key, count in requests.iteritems() if count)
+    result['totalRequests'] = sum(result['requests'].values())
+    result['bytesSent'] = after['bytesIn'] - before['bytesIn']
+    result['bytesReceived'] = after['bytesOut'] - before['bytesOut']
+    result['retries'] = delicious2fluid.retryPolicy.retries
+    result['drops'] = delicious2fluid.retryPolicy.drops
+    return result
+
+
+# Run in a fresh interpreter to time importing delicious2fluid.
+IMPORT_SCRIPT = """
+import json, sys, time
+before = len(sys.modules)
+start = time.time()
+import delicious2fluid
+print(json.dumps([time.time() - start, len(sys.modules) - before]))
+"""
+
+
+def importTime(runs=10):
+    """
+    Imports delicious2fluid in runs fresh processes and returns a dict of the
+    fastest and median times taken and the number of modules it loaded.
+    """
+    times = []
+    for i in range(runs):
+        output = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT],
+            cwd=HERE, stdout=subprocess.PIPE).communicate()[0]
+        seconds, modules = json.loads(output)
+        times.append(seconds)
+    times.sort()
+    return {'runs': runs, 'minSeconds': times[0],
+        'medianSeconds': times[len(times) // 2], 'modules': modules}
+
+
+def freePort():
+    """
+    Returns a TCP port that is free to listen on.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def startServer(latency, errorRate):
+    """
+    Starts the fake FluidDB in a separate process and returns the process and
+    its url once it is accepting connections.
+    """
+    port = freePort()
+    server = subprocess.Popen([sys.executable,
+        os.path.join(HERE, 'fakefluiddb.py'), '--port', str(port),
+        '--latency', str(latency), '--error-rate', str(errorRate)],
+        stdout=open(os.devnull, 'w'))
+    for attempt in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            time.sleep(0.05)
+    return server, 'http://127.0.0.1:%d' % port
+
+
+def parseArgs(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes', default='1000,10000,100000',
+        help='comma separated export sizes to benchmark [default: %default]')
+    parser.add_option('-w', '--workers', type='int', default=1,
+        help='number of objects to import concurrently [default: %default]')
+    parser.add_option('-b', '--batch-size', type='int', default=1,
+        dest='batchSize', help='number of bookmarks to tag with a single'
+        ' request [default: %default]')
+    parser.add_option('-l', '--latency', type='float', default=0.0,
+        help='seconds the fake FluidDB delays each response by'
+        ' [default: %default]')
+    parser.add_option('-e', '--error-rate', type='float', default=0.0,
+        dest='errorRate', help='proportion of requests the fake FluidDB'
+        ' fails with a 503 [default: %default]')
+    parser.add_option('-i', '--imports', type='int', default=10,
+        help='number of fresh processes to time importing delicious2fluid in'
+        ' [default: %default]')
+    parser.add_option('-o', '--output', default=None,
+        help='file to write the JSON results to [default: stdout]')
+    parser.add_option('-p', '--profile', default=None,
+        help='directory to write profiles of each phase of the imports to'
+        ' (one subdirectory per size)')
+    parser.add_option('--debug-log', action='store_true', default=False,
+        dest='debugLog', help='keep writing the debug log to d2f.log')
+    # used internally to run a single benchmark in a child process
+    parser.add_option('--run', default=None, help='export file to benchmark')
+    parser.add_option('--url', default=None, help='fake FluidDB url')
+    parser.add_option('--root', default='bench', help='namespace to use')
+    options, args = parser.parse_args(argv)
+    return options
+
+
+def main(argv=None):
+    options = parseArgs(argv)
+    if not options.debugLog:
+        delicious2fluid.logger.setLevel(logging.WARNING)
+    if options.run:
+        result = runOne(options.run, options.url, options.root,
+            options.workers, options.batchSize, options.profile)
+        print(json.dumps(result))
+        return
+    server, url = startServer(options.latency, options.errorRate)
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for i, size in enumerate(options.sizes.split(',')):
+            size = int(size)
+            path = os.path.join(directory, 'export%d.xml' % size)
+            generateExport(path, size)
+            command = [sys.executable, os.path.abspath(__file__), '--run',
+                path, '--url', url, '--root', 'bench/run%d' % i,
+                '--workers', str(options.workers), '--batch-size',
+                str(options.batchSize)]
+            if options.debugLog:
+                command.append('--debug-log')
+            if options.profile:
+                command.extend(['--profile',
+                    os.path.join(options.profile, str(size))])
+            child = subprocess.Popen(command, stdout=subprocess.PIPE)
+            output = child.communicate()[0]
+            result = json.loads(output.splitlines()[-1])
+            result['size'] = size
+            result['exportBytes'] = os.path.getsize(path)
+            results.append(result)
+            os.remove(path)
+    finally:
+        server.terminate()
+        shutil.rmtree(directory)
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {'workers': options.workers,
+            'batchSize': options.batchSize, 'latency': options.latency,
+            'errorRate': options.errorRate},
+        'results': results,
+        'import': importTime(options.imports),
+    }
+    output = sys.stdout
+    if options.output:
+        output = open(options.output, 'w')
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -28,28 +28,173 @@ your root namespace:
 USERNAME/TAGNAME
 """
 
+# The HTTP, XML, compression and multiprocessing modules are slow to import
+# and not needed by everything that uses this module (parseXml, build_url...)
+# so they're imported by the functions that need them instead of up here. The
+# HTTP modules are imported once, by _http(), rather than on every request.
 import logging
+import os
+import random
 import sys
-from getpass import getpass
-from xml.dom.minidom import parseString
-import httplib2
-import urllib
+from StringIO import StringIO
 import types
+import itertools
+import urlparse
+from contextlib import contextmanager
+import threading
+import Queue
+import time
 if sys.version_info < (2, 6):
     import simplejson as json
 else:
     import json
 
+# The HTTP modules, set by _http() when first needed.
+httplib = socket = urllib = httplib2 = None
+
+
+def _http():
+    """
+    Imports the modules used to make HTTP requests into the module namespace
+    the first time it's called. Importing takes the global import lock, so
+    this keeps requests from contending on it once the modules are loaded.
+    """
+    global httplib, socket, urllib, httplib2
+    if httplib2 is None:
+        import httplib
+        import socket
+        import urllib
+        # last, since it's what's checked
+        import httplib2
+
 # Logging
 LOG_FILENAME = 'd2f.log'
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Hands log records to a background thread that passes them on to the
+    target handlers, so the threads doing the import never wait for messages
+    to be formatted and written. Since formatting happens on the background
+    thread, pass the values to log as arguments (logger.info('%s', value))
+    rather than formatting the message first.
+
+    Records of ERROR and above are written before the call that logged them
+    returns, as is everything logged before a call to flush() (which the
+    logging module makes on exit).
+    """
+
+    def __init__(self, *targets):
+        logging.Handler.__init__(self)
+        self.targets = list(targets)
+        self._queue = None
+        self._pid = None
+        self._startLock = threading.Lock()
+
+    def _start(self):
+        """
+        Returns the queue of records to be written, starting the background
+        thread the first time this is called in a process.
+        """
+        # a forked process (see migrateAccounts) needs its own thread
+        if self._pid != os.getpid():
+            self._startLock.acquire()
+            try:
+                if self._pid != os.getpid():
+                    self._queue = Queue.Queue()
+                    thread = threading.Thread(target=self._write,
+                        args=(self._queue, ))
+                    thread.setDaemon(True)
+                    thread.start()
+                    self._pid = os.getpid()
+            finally:
+                self._startLock.release()
+        return self._queue
+
+    def _write(self, queue):
+        """
+        Passes the queued records on to the target handlers.
+        """
+        while True:
+            record = queue.get()
+            try:
+                for target in self.targets:
+                    if record.levelno >= target.level:
+                        target.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                queue.task_done()
+
+    def emit(self, record):
+        queue = self._start()
+        queue.put(record)
+        if record.levelno >= logging.ERROR:
+            queue.join()
+
+    def afterFork(self):
+        """
+        Replaces the locks copied from the parent process by a fork (which
+        may have been held by one of its other threads) so the child process
+        can't deadlock writing its first record.
+        """
+        self.createLock()
+        for target in self.targets:
+            target.createLock()
+        self._startLock = threading.Lock()
+        self._pid = None
+
+    def flush(self):
+        """
+        Waits for every record logged so far to be written.
+        """
+        if self._pid == os.getpid():
+            self._queue.join()
+        for target in self.targets:
+            target.flush()
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets through the records below WARNING about only one in every so many
+    objects (or tags), to cut down on the messages logged for every object.
+    Call sample() before handling each object: whether all the messages about
+    it are logged or dropped is decided then, for the thread handling it.
+    """
+
+    def __init__(self, every=1):
+        logging.Filter.__init__(self)
+        self.every = every
+        self._count = itertools.count()
+        self._local = threading.local()
+
+    def sample(self):
+        """
+        Decides whether the messages logged by this thread about the next
+        object are let through.
+        """
+        self._local.keep = self._count.next() % self.every == 0
+
+    def filter(self, record):
+        return (record.levelno >= logging.WARNING or self.every <= 1 or
+            getattr(self._local, 'keep', True))
+
+
 logger = logging.getLogger('d2f')
 logger.setLevel(logging.DEBUG)
-logfile_handler = logging.FileHandler(LOG_FILENAME)
+# the log file is only created once there's something to write to it
+logfile_handler = logging.FileHandler(LOG_FILENAME, delay=True)
 logfile_handler.setLevel(logging.DEBUG)
 log_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s -"\
 " %(message)s")
 logfile_handler.setFormatter(log_format)
-logger.addHandler(logfile_handler)
+async_handler = AsyncHandler(logfile_handler)
+logger.addHandler(async_handler)
+# The messages logged for every tag and object are sampled by objectSampler
+# (see --log-sample).
+objectLogger = logging.getLogger('d2f.objects')
+objectSampler = SampleFilter()
+objectLogger.addFilter(objectSampler)
 
 """
 FLUIDDB RELATED FUNCTIONS
@@ -77,13 +222,650 @@ global_headers = {
 }
 
 
+# The maximum number of HTTP clients (and hence persistent connections to each
+# host) kept open by the shared connection pool.
+DEFAULT_POOL_SIZE = 10
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of httplib2.Http clients shared by every request made
+    by this script. Each client keeps its connections alive and keyed by host
+    so, rather than paying for a new TCP + TLS handshake per request, calls to
+    FluidDB (and delicious) reuse an already open connection.
+
+    Clients are created lazily up to size. When they are all in use a request
+    blocks until one is released.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self._idle = Queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns an idle client from the pool, creating one if the pool isn't
+        yet full.
+        """
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            self._lock.acquire()
+            try:
+                if self._created < self.size:
+                    _http()
+                    self._created += 1
+                    return httplib2.Http(timeout=self.timeout)
+            finally:
+                self._lock.release()
+        return self._idle.get()
+
+    def release(self, http):
+        """
+        Returns the client to the pool so its connections can be reused.
+        """
+        self._idle.put(http)
+
+    def request(self, url, method='GET', body=None, headers=None):
+        """
+        Makes the request with a pooled client and returns the (response,
+        content) tuple from httplib2.
+        """
+        http = self.acquire()
+        try:
+            return http.request(url, method, body, headers)
+        finally:
+            self.release(http)
+
+
+pool = ConnectionPool()
+
+
+def configurePool(size=DEFAULT_POOL_SIZE, timeout=None):
+    """
+    Replaces the shared connection pool with one holding at most size clients
+    whose sockets time out after timeout seconds.
+    """
+    global pool
+    pool = ConnectionPool(size, timeout)
+
+
+# HTTP status codes that mean a request is worth trying again. FluidDB uses
+# 429 and 503 to tell clients to slow down.
+RETRY_STATUSES = set((429, 500, 502, 503, 504))
+PUSHBACK_STATUSES = set((429, 503))
+
+
+class RetryPolicy(object):
+    """
+    Decides how many times and how long to wait before retrying a request
+    that failed with one of the RETRY_STATUSES or a connection error. The delay
+    grows exponentially from baseDelay up to maxDelay with "full jitter" (a
+    random delay between zero and the exponential value) so lots of workers
+    don't all retry at once. A Retry-After header from the server is honoured.
+
+    Keeps count of the number of retries made and the number of requests that
+    were dropped after running out of retries.
+    """
+
+    def __init__(self, maxRetries=5, baseDelay=0.5, maxDelay=30.0):
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.retries = 0
+        self.drops = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, response=None):
+        """
+        Returns the number of seconds to wait before making the given retry
+        attempt (counting from zero).
+        """
+        if response is not None and 'retry-after' in response:
+            try:
+                return min(float(response['retry-after']), self.maxDelay)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.maxDelay,
+            self.baseDelay * (2 ** attempt)))
+
+    def retried(self):
+        """
+        Counts a retry.
+        """
+        self._lock.acquire()
+        try:
+            self.retries += 1
+        finally:
+            self._lock.release()
+
+    def dropped(self):
+        """
+        Counts a request that is given up on.
+        """
+        self._lock.acquire()
+        try:
+            self.drops += 1
+        finally:
+            self._lock.release()
+
+
+class RateLimiter(object):
+    """
+    A token bucket allowing rate requests a second with bursts of up to burst
+    requests. The rate adapts to the server: it halves (down to minRate) each
+    time the server pushes back and creeps back up towards maxRate (the
+    starting rate unless given) with each successful request.
+    """
+
+    def __init__(self, rate, burst=1, minRate=0.1, maxRate=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.minRate = minRate
+        self.maxRate = float(maxRate or rate)
+        self.throttled = 0
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may be made.
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self._tokens = min(self.burst,
+                    self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
+    def backoff(self):
+        """
+        Halves the rate because the server has asked us to slow down.
+        """
+        self._lock.acquire()
+        try:
+            self.rate = max(self.minRate, self.rate / 2)
+            self.throttled += 1
+        finally:
+            self._lock.release()
+
+    def success(self):
+        """
+        Nudges the rate back up after a successful request.
+        """
+        self._lock.acquire()
+        try:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 100)
+        finally:
+            self._lock.release()
+
+
+# The upper bounds (in seconds) of the buckets in the request latency
+# histograms.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def endpointKey(method, url):
+    """
+    Returns the key requests are grouped under in the metrics: FluidDB
+    requests by the first element of their path and any others by host.
+    """
+    if url.startswith(instance):
+        endpoint = '/' + urlparse.urlparse(url).path.split('/')[1]
+    else:
+        endpoint = urlparse.urlparse(url).netloc
+    return '%s %s' % (method, endpoint)
+
+
+class Metrics(object):
+    """
+    Collects timings for each phase of an import (fetch, parse, namespace,
+    tags, objects) and, for each endpoint, the number of requests, their
+    statuses, a histogram of their latencies and the bytes sent and received.
+    Phases may overlap: when the export is streamed it is parsed whilst the
+    objects are imported.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.endpoints = {}
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self._lock = threading.Lock()
+
+    def addTime(self, phase, seconds):
+        """
+        Adds the seconds to the time spent in the phase.
+        """
+        self._lock.acquire()
+        try:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        finally:
+            self._lock.release()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the code in the with block as part of the named phase (and
+        profiles it if the profiler is set).
+        """
+        start = time.time()
+        try:
+            if profiler is not None:
+                with profiler.phase(name):
+                    yield
+            else:
+                yield
+        finally:
+            self.addTime(name, time.time() - start)
+
+    def timed(self, phase, iterable):
+        """
+        Yields the items from the iterable, adding the time spent producing
+        them (e.g. parsing the export) to the phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                self.addTime(phase, time.time() - start)
+                return
+            self.addTime(phase, time.time() - start)
+            yield item
+
+    def record(self, method, url, status, seconds, sent, received):
+        """
+        Records a request to the url (status is None if it failed to get a
+        response).
+        """
+        key = endpointKey(method, url)
+        bucket = 'inf'
+        for bound in LATENCY_BUCKETS:
+            if seconds <= bound:
+                bucket = str(bound)
+                break
+        self._lock.acquire()
+        try:
+            stats = self.endpoints.setdefault(key, {'count': 0,
+                'seconds': 0.0, 'maxSeconds': 0.0, 'statuses': {},
+                'latency': {}, 'bytesSent': 0, 'bytesReceived': 0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['maxSeconds'] = max(stats['maxSeconds'], seconds)
+            status = str(status)
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            stats['latency'][bucket] = stats['latency'].get(bucket, 0) + 1
+            stats['bytesSent'] += sent
+            stats['bytesReceived'] += received
+            self.bytesSent += sent
+            self.bytesReceived += received
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """
+        Returns a dict of everything collected, suitable for JSON encoding.
+        """
+        self._lock.acquire()
+        try:
+            return json.loads(json.dumps({'phases': self.phases,
+                'endpoints': self.endpoints, 'bytesSent': self.bytesSent,
+                'bytesReceived': self.bytesReceived}))
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """
+        Returns a list of lines summarising the metrics for people to read.
+        """
+        report = self.report()
+        lines = []
+        for name, seconds in sorted(report['phases'].items(),
+            key=lambda item: -item[1]):
+            lines.append('%-10s %10.2fs' % (name, seconds))
+        for key, stats in sorted(report['endpoints'].items()):
+            lines.append('%-24s %7d requests, %8.3fs mean, %8.3fs max, %s' %
+                (key, stats['count'], stats['seconds'] / stats['count'],
+                stats['maxSeconds'], ', '.join(['%s: %d' % status
+                for status in sorted(stats['statuses'].items())])))
+        lines.append('%d bytes sent, %d bytes received' %
+            (report['bytesSent'], report['bytesReceived']))
+        return lines
+
+    def export(self, path):
+        """
+        Writes the metrics to path as JSON.
+        """
+        output = open(path, 'w')
+        json.dump(self.report(), output, indent=2, sort_keys=True)
+        output.close()
+
+
+metrics = Metrics()
+
+
+def peakMemory():
+    """
+    Returns the peak resident memory of this process in kilobytes (or None if
+    it can't be found out).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+class Profiler(object):
+    """
+    Profiles the phases of an import (see Metrics.phase) and writes a report
+    on each to the directory:
+
+        PHASE.prof = the cProfile statistics (load them with pstats)
+        PHASE.txt = the hottest functions and where memory went
+
+    cProfile only profiles the thread it's enabled in so a profiler is also
+    enabled in every thread started during the phase, and the statistics of
+    those that have finished by the end of it are included. A phase starting
+    whilst another is being profiled is profiled as part of that one.
+
+    Python 2 has no tracemalloc so the memory report gives the growth in peak
+    resident memory and the types whose live objects (those tracked by the
+    garbage collector) grew the most in number and size.
+    """
+
+    def __init__(self, directory, top=25, memory=True):
+        self.directory = directory
+        self.top = top
+        self.memory = memory
+        self._active = None
+        self._runs = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _liveObjects(self):
+        """
+        Returns a dict mapping type names to the number and size of the live
+        objects of that type.
+        """
+        import gc
+        live = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            count, size = live.get(name, (0, 0))
+            live[name] = (count + 1, size + sys.getsizeof(obj, 0))
+        return live
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Profiles the code in the with block as the named phase.
+        """
+        if self._active is not None:
+            yield
+            return
+        import cProfile
+        self._active = name
+        main = cProfile.Profile()
+        threads = []
+        lock = threading.Lock()
+
+        def startThread(frame, event, arg):
+            profile = cProfile.Profile()
+            lock.acquire()
+            try:
+                threads.append((threading.currentThread(), profile))
+            finally:
+                lock.release()
+            # replaces this function as the thread's profiler
+            profile.enable()
+        live = self.memory and self._liveObjects() or None
+        peak = peakMemory()
+        start = time.time()
+        threading.setprofile(startThread)
+        main.enable()
+        try:
+            yield
+        finally:
+            main.disable()
+            threading.setprofile(None)
+            seconds = time.time() - start
+            self._active = None
+            self._report(name, seconds, main, threads, peak, live)
+
+    def _report(self, name, seconds, main, threads, peak, live):
+        """
+        Writes the reports on the phase.
+        """
+        import pstats
+        run = self._runs[name] = self._runs.get(name, 0) + 1
+        if run > 1:
+            name = '%s-%d' % (name, run)
+        path = os.path.join(self.directory, name)
+        report = open(path + '.txt', 'w')
+        try:
+            stats = pstats.Stats(main, stream=report)
+            running = 0
+            for thread, profile in threads:
+                if thread.isAlive():
+                    running += 1
+                else:
+                    stats.add(profile)
+            stats.dump_stats(path + '.prof')
+            report.write('Phase %s took %.2fs\n' % (name, seconds))
+            report.write('Profiled %d threads (%d still running so left'
+                ' out)\n' % (len(threads) + 1 - running, running))
+            if peak is not None:
+                report.write('Peak resident memory grew from %dKB to %dKB\n'
+                    % (peak, peakMemory()))
+            if live is not None:
+                growth = []
+                for kind, (count, size) in self._liveObjects().iteritems():
+                    before = live.get(kind, (0, 0))
+                    growth.append((size - before[1], count - before[0],
+                        kind))
+                growth.sort(reverse=True)
+                report.write('\nLive objects that grew the most:\n')
+                for size, count, kind in growth[:self.top]:
+                    report.write('%12d bytes %10d objects  %s\n' % (size,
+                        count, kind))
+            report.write('\nHottest functions by internal time:\n')
+            stats.sort_stats('time').print_stats(self.top)
+            report.write('Hottest functions by cumulative time:\n')
+            stats.sort_stats('cumulative').print_stats(self.top)
+        finally:
+            report.close()
+        logger.info('Wrote the profile of the %s phase to %s.txt' %
+            (name, path))
+
+
+# The phases of an import are profiled if profiler is set to a Profiler (see
+# --profile).
+profiler = None
+
+
+# The statuses a planned request is answered with during a dry run.
+PLANNED_STATUSES = {'GET': '404', 'POST': '201', 'PUT': '204',
+    'DELETE': '204'}
+
+
+class Planner(object):
+    """
+    Stands in for FluidDB during a dry run. Rather than being made, each
+    request that call() would make is counted (by endpoint, as in the metrics)
+    along with the bytes its body would send, and is answered as though it
+    succeeded. Lookups answer that nothing exists, so everything is planned
+    to be created.
+
+    If diff is true the lookups (GETs) are really made so only the namespaces
+    and tags missing from FluidDB are planned (when an ExistenceCache is
+    used). If a path is given each planned request is also written to it as a
+    line of JSON.
+    """
+
+    def __init__(self, diff=False, path=None):
+        self.diff = diff
+        self.endpoints = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            self._file = open(path, 'w')
+
+    def plan(self, method, url, body=None):
+        """
+        Records the request and returns the (response, result) tuple that
+        call() should return for it.
+        """
+        sent = len(body or '')
+        key = endpointKey(method, url)
+        self._lock.acquire()
+        try:
+            stats = self.endpoints.setdefault(key, {'count': 0,
+                'bytesSent': 0})
+            stats['count'] += 1
+            stats['bytesSent'] += sent
+            if self._file is not None:
+                self._file.write(json.dumps([method, url, sent]) + '\n')
+        finally:
+            self._lock.release()
+        _http()
+        response = httplib2.Response({
+            'status': PLANNED_STATUSES.get(method, '200')})
+        return response, None
+
+    def report(self, rate=None):
+        """
+        Returns a dict of the planned requests, suitable for JSON encoding.
+        If a rate (requests a second) is given the time the requests would
+        take at that rate is included.
+        """
+        self._lock.acquire()
+        try:
+            report = json.loads(json.dumps({'endpoints': self.endpoints}))
+        finally:
+            self._lock.release()
+        report['requests'] = sum([stats['count']
+            for stats in report['endpoints'].values()])
+        report['bytesSent'] = sum([stats['bytesSent']
+            for stats in report['endpoints'].values()])
+        if rate:
+            report['rate'] = rate
+            report['seconds'] = report['requests'] / float(rate)
+        return report
+
+    def summary(self, rate=None):
+        """
+        Returns a list of lines summarising the plan for people to read.
+        """
+        report = self.report(rate)
+        lines = []
+        for key, stats in sorted(report['endpoints'].items()):
+            lines.append('%-24s %7d requests, %10d bytes' % (key,
+                stats['count'], stats['bytesSent']))
+        lines.append('%d requests planned sending %d bytes' %
+            (report['requests'], report['bytesSent']))
+        if rate:
+            lines.append('At %g requests a second this would take %.1fs' %
+                (rate, report['seconds']))
+        return lines
+
+    def close(self):
+        """
+        Closes the file the planned requests are written to (if any).
+        """
+        if self._file is not None:
+            self._file.close()
+
+
+# Requests to FluidDB are retried according to retryPolicy and, if limiter is
+# set to a RateLimiter, made no faster than it allows. If planner is set to a
+# Planner they are planned rather than made (see Planner for the exceptions).
+retryPolicy = RetryPolicy()
+limiter = None
+planner = None
+
+
+def request(url, method='GET', body=None, headers=None, limiter=None):
+    """
+    Makes an HTTP request using the shared connection pool and returns the
+    (response, content) tuple from httplib2. Requests that fail with one of
+    the RETRY_STATUSES or a connection error or timeout are retried according
+    to the retryPolicy. Failing to look up the host isn't going to get any
+    better so is raised straight away. If a RateLimiter is given each attempt
+    waits for its turn and the limiter is told when the server pushes back.
+
+    Once the retries are used up the last response is returned (or the last
+    network error raised) and the request counted as dropped.
+    """
+    _http()
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        response = content = error = None
+        start = time.time()
+        try:
+            response, content = pool.request(url, method, body, headers)
+            status = response.status
+        except (socket.gaierror, httplib2.ServerNotFoundError):
+            raise
+        except (socket.error, httplib.HTTPException) as ex:
+            error = ex
+            status = None
+        metrics.record(method, url, status, time.time() - start,
+            len(body or ''), len(content or ''))
+        if status is not None and status not in RETRY_STATUSES:
+            if limiter is not None:
+                limiter.success()
+            return response, content
+        if limiter is not None and status in PUSHBACK_STATUSES:
+            limiter.backoff()
+        if attempt >= retryPolicy.maxRetries:
+            retryPolicy.dropped()
+            logger.error('Giving up on %s %s after %d attempts (%s)',
+                method, url, attempt + 1, status or error)
+            if error is not None:
+                raise error
+            return response, content
+        delay = retryPolicy.delay(attempt, response)
+        retryPolicy.retried()
+        logger.warning('Retrying %s %s in %.2fs (%s)', method, url, delay,
+            status or error)
+        time.sleep(delay)
+        attempt += 1
+
+
+def authorization(username, password):
+    """
+    Returns the value of the 'Authorization' header for the given username
+    and password.
+    """
+    userpass = username + ':' + password
+    return 'Basic ' + userpass.encode('base64').strip()
+
+
 def login(username, password):
     """
     Creates the 'Authorization' token from the given username and password.
     """
-    userpass = username + ':' + password
-    auth = 'Basic ' + userpass.encode('base64').strip()
-    global_headers['Authorization'] = auth
+    global_headers['Authorization'] = authorization(username, password)
 
 
 def logout():
@@ -109,7 +891,7 @@ def call(method, path, body=None, mime=None, tags=[], custom_headers={}, **kw):
     headers = A dictionary containing additional headers to send in the request
     **kw = Query-string arguments to be appended to the URL
     """
-    http = httplib2.Http()
+    _http()
     # build the URL
     url = build_url(path)
     if kw:
@@ -145,9 +927,11 @@ def call(method, path, body=None, mime=None, tags=[], custom_headers={}, **kw):
             # No way to work out what content-type to send to FluidDB so
             # bail out.
             raise TypeError("You must supply a mime-type")
-    response, content = http.request(url, method, body, headers)
-    if ((response['content-type'] == 'application/json' or
-        response['content-type'] == 'application/vnd.fluiddb.value+json')
+    if planner is not None and (method != 'GET' or not planner.diff):
+        return planner.plan(method, url, body)
+    response, content = request(url, method, body, headers, limiter)
+    if ((response.get('content-type') == 'application/json' or
+        response.get('content-type') == 'application/vnd.fluiddb.value+json')
         and content):
         result = json.loads(content)
     else:
@@ -181,18 +965,322 @@ def isprimitive(body):
         return False
 
 
+def succeeded(response, *allowed):
+    """
+    Given the response headers from call will return a boolean to indicate if
+    the request succeeded. Any additional status codes passed in as allowed
+    also count as success (e.g. 412 when creating something that already
+    exists).
+    """
+    status = int(response['status'])
+    return 200 <= status < 300 or status in allowed
+
+
+# Stands in for a key missing from an LRUCache.
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    A thread-safe cache of the values computed for at most maxSize keys that
+    counts its hits and misses. When it's full the least recently used
+    quarter of the keys are dropped in one go, which keeps hits as cheap as
+    a dict lookup: they don't take the lock (so the hit count may be slightly
+    out when many threads use the cache at once).
+    """
+
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._used = {}
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, compute):
+        """
+        Returns the value for the key, calling compute(key) to work it out if
+        it isn't cached.
+        """
+        value = self._items.get(key, _missing)
+        if value is not _missing:
+            self.hits += 1
+            self._used[key] = self._clock.next()
+            return value
+        value = compute(key)
+        self._lock.acquire()
+        try:
+            self.misses += 1
+            self._items[key] = value
+            self._used[key] = self._clock.next()
+            if len(self._items) > self.maxSize:
+                keep = self.maxSize * 3 // 4
+                for old in sorted(self._used, key=self._used.get)[:-keep]:
+                    # a hit may have touched a key as it was being dropped
+                    self._items.pop(old, None)
+                    self._used.pop(old, None)
+        finally:
+            self._lock.release()
+        return value
+
+
+# The quoted paths of the URLs of recent requests (see build_url).
+DEFAULT_URL_CACHE_SIZE = 1024
+urlCache = LRUCache(DEFAULT_URL_CACHE_SIZE)
+
+
+def quotePath(path):
+    """
+    Returns the quoted form of the path: a string or a tuple of path elements
+    (which may contain slashes).
+    """
+    _http()
+    if isinstance(path, tuple):
+        return '/' + '/'.join([urllib.quote(element, safe='')
+            for element in path])
+    return urllib.quote(path)
+
+
 def build_url(path):
     """
     Given a path that is either a string or list of path elements, will return
-    the correct URL
+    the correct URL. The same few paths are used over and over so their quoted
+    forms are remembered in urlCache.
     """
-    url = instance
     if isinstance(path, list):
-        url += '/'
-        url += '/'.join([urllib.quote(element, safe='') for element in path])
-    else:
-        url += urllib.quote(path)
-    return url
+        path = tuple(path)
+    return instance + urlCache.get(path, quotePath)
+
+
+class FluidDBBackend(object):
+    """
+    The operations an import is made up of, carried out by FluidDB. Each
+    returns the (response, result) tuple from call.
+    """
+
+    def createNamespace(self, parent, name, description):
+        return call('POST', tagPaths(parent).namespaces, {'name': name,
+            'description': description})
+
+    def createTag(self, namespace, name, description):
+        return call('POST', tagPaths(namespace).tags, {'name': name,
+            'description': description, 'indexed': False})
+
+    def createObject(self, about):
+        return call('POST', '/objects', {'about': about})
+
+    def setValues(self, query, values):
+        """
+        Sets the values (a dict mapping tag paths to {"value": ...}) on the
+        objects matching the query.
+        """
+        return call('PUT', '/values', values, query=query)
+
+    def setBatchValues(self, queries):
+        """
+        Sets values on the objects matching each of several queries with a
+        single request. The queries are a list of [query, values] pairs.
+        """
+        return call('PUT', '/values', {'queries': queries})
+
+    def removeValues(self, query, tags):
+        """
+        Removes the tags (a list of paths) from the objects matching the
+        query.
+        """
+        return call('DELETE', '/values', tags=tags, query=query)
+
+    def listNamespace(self, namespace):
+        """
+        Lists the names of the tags and namespaces in the namespace.
+        """
+        return call('GET', tagPaths(namespace).namespaces, returnTags=True,
+            returnNamespaces=True)
+
+    def close(self):
+        pass
+
+
+# The number of operations a LocalSink writes to disk at a time, and the line
+# that marks the end of each batch written.
+DEFAULT_SINK_BATCH_SIZE = 1000
+COMMIT_MARKER = '["commit"]'
+
+
+class LocalSink(object):
+    """
+    Stages an import on local disk instead of writing it to FluidDB, so it
+    runs at the speed of the disk and can be checked before being replayed to
+    FluidDB (see replay).
+
+    Each operation is recorded in the file at path as a line of JSON holding
+    its name and arguments (with the same tag paths as would be used in
+    FluidDB). Operations are buffered and written batchSize at a time, each
+    batch with a single write ending in a commit marker that is synced to
+    disk. Any operations after the last commit marker (a batch torn by a
+    crash) are ignored when the file is read back. Every operation is answered
+    as though it succeeded, and listNamespace answers from what has been
+    staged.
+    """
+
+    # the status each operation is answered with
+    STATUSES = {'namespace': '201', 'tag': '201', 'object': '201',
+        'values': '204', 'batch': '204', 'remove': '204'}
+
+    def __init__(self, path, batchSize=DEFAULT_SINK_BATCH_SIZE):
+        self.path = path
+        self.batchSize = batchSize
+        self.operations = 0
+        self._namespaces = set()
+        self._tags = set()
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+
+    def _stage(self, operation, *args):
+        """
+        Records the operation and returns the (response, result) tuple call
+        would have returned had it succeeded.
+        """
+        _http()
+        self._lock.acquire()
+        try:
+            self._buffer.append(json.dumps([operation] + list(args)))
+            self.operations += 1
+            if len(self._buffer) >= self.batchSize:
+                self._write()
+        finally:
+            self._lock.release()
+        return httplib2.Response({'status': self.STATUSES[operation]}), None
+
+    def _write(self):
+        """
+        Writes the buffered operations and a commit marker to disk in one go.
+        """
+        if self._buffer:
+            self._buffer.append(COMMIT_MARKER)
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._buffer = []
+
+    def createNamespace(self, parent, name, description):
+        self._namespaces.add('/'.join([parent, name]))
+        return self._stage('namespace', parent, name, description)
+
+    def createTag(self, namespace, name, description):
+        self._tags.add('/'.join([namespace, name]))
+        return self._stage('tag', namespace, name, description)
+
+    def createObject(self, about):
+        return self._stage('object', about)
+
+    def setValues(self, query, values):
+        return self._stage('values', query, values)
+
+    def setBatchValues(self, queries):
+        return self._stage('batch', queries)
+
+    def removeValues(self, query, tags):
+        return self._stage('remove', query, tags)
+
+    def listNamespace(self, namespace):
+        _http()
+        prefix = namespace + '/'
+        children = lambda paths: [path[len(prefix):] for path in paths
+            if path.startswith(prefix) and '/' not in path[len(prefix):]]
+        self._lock.acquire()
+        try:
+            result = {'tagNames': children(self._tags),
+                'namespaceNames': children(self._namespaces)}
+        finally:
+            self._lock.release()
+        return httplib2.Response({'status': '200'}), result
+
+    def close(self):
+        """
+        Writes any buffered operations and closes the file.
+        """
+        self._lock.acquire()
+        try:
+            self._write()
+            self._file.close()
+        finally:
+            self._lock.release()
+
+
+def readSink(path):
+    """
+    Yields the (operation, args) tuples staged in the file at path by a
+    LocalSink. Only whole batches are yielded: any operations after the last
+    commit marker are skipped.
+    """
+    sink = open(path, 'r')
+    try:
+        batch = []
+        for line in sink:
+            if line.rstrip('\n') == COMMIT_MARKER:
+                for record in batch:
+                    yield record
+                batch = []
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            batch.append((record[0], record[1:]))
+    finally:
+        sink.close()
+
+
+# The order operations are replayed in: each kind only relies on the kinds
+# before it having been done.
+REPLAY_ORDER = ('namespace', 'tag', 'object', 'values', 'batch', 'remove')
+
+
+def replay(path, target=None, workers=1):
+    """
+    Replays the operations staged in the file at path by a LocalSink to the
+    target backend (the FluidDB backend by default). Namespaces are created
+    in the order they were staged, so parents come before their children.
+    Then the tags, objects, values, batches and removals are each replayed
+    concurrently by up to workers threads. Returns a dict of the number of
+    operations of each kind that succeeded.
+    """
+    if target is None:
+        target = FluidDBBackend()
+    operations = dict((kind, []) for kind in REPLAY_ORDER)
+    for operation, args in readSink(path):
+        operations[operation].append(args)
+    methods = {'namespace': target.createNamespace,
+        'tag': target.createTag, 'object': target.createObject,
+        'values': target.setValues, 'batch': target.setBatchValues,
+        'remove': target.removeValues}
+    replayed = {}
+    for kind in REPLAY_ORDER:
+        logger.info('Replaying %d %s operations' %
+            (len(operations[kind]), kind))
+        done = []
+
+        def apply(args, method=methods[kind]):
+            objectSampler.sample()
+            response = method(*args)
+            objectLogger.debug(response)
+            if succeeded(response[0], 412):
+                done.append(args)
+        runConcurrently(apply, operations[kind],
+            kind != 'namespace' and workers or 1)
+        replayed[kind] = len(done)
+    return replayed
+
+
+# Where the namespaces, tags, objects and values of an import are written
+# (see FluidDBBackend and LocalSink).
+backend = FluidDBBackend()
 
 
 """
@@ -202,15 +1290,41 @@ The actual logic and processing happens in these functions.
 """
 
 
-def getBookmarks(username, password):
+DELICIOUS_URL = 'https://api.del.icio.us/v1/posts/all'
+# The number of bookmarks to ask delicious for at a time when paging.
+DEFAULT_PAGE_SIZE = 1000
+# Delicious throttles API clients that don't wait at least this many seconds
+# between requests.
+DELICIOUS_INTERVAL = 1.0
+
+
+def deliciousHeaders(username, password, compress=True):
+    """
+    Returns the headers for a request to delicious. These are kept apart from
+    the global_headers used for FluidDB so both can be used at once. Unless
+    compress is False the response is gzip (or deflate) encoded.
+    """
+    headers = {'Accept': '*/*',
+        'Authorization': authorization(username, password)}
+    if not compress:
+        # httplib2 asks for compressed responses by default
+        headers['accept-encoding'] = 'identity'
+    return headers
+
+
+def getBookmarks(username, password, compress=True, **kw):
     """
     Given a user's delicious username and password grabs the XML using the API.
+    Any keyword arguments (e.g. start and results) are appended to the query
+    string.
     """
+    _http()
     logger.info('Grabbing bookmarks from delicious')
-    http = httplib2.Http()
-    login(username, password)
-    url = "https://api.del.icio.us/v1/posts/all"
-    response, content = http.request(url, 'GET', None, global_headers)
+    url = DELICIOUS_URL
+    if kw:
+        url = url + '?' + urllib.urlencode(kw)
+    response, content = request(url, 'GET', None,
+        deliciousHeaders(username, password, compress))
     if response['status'] == '200':
         logger.info('200 OK')
         return content
@@ -219,163 +1333,1731 @@ def getBookmarks(username, password):
         raise Exception("Can't get bookmarks from delicious")
 
 
+def iterPages(username, password, pageSize=DEFAULT_PAGE_SIZE, compress=True,
+    interval=None):
+    """
+    Yields an (objects, tags) tuple for each page of pageSize bookmarks from
+    delicious in turn: the list of Bookmark objects on the page and the set of
+    tags they use (see iterParseXml). The next page is fetched and parsed by a
+    background thread whilst the current one is being imported so the network
+    and the import overlap. Only one page is ever held in reserve so memory is
+    capped by the page size. Requests are at least interval seconds apart
+    (DELICIOUS_INTERVAL by default).
+    """
+    if interval is None:
+        interval = DELICIOUS_INTERVAL
+    pages = Queue.Queue(1)
+    stop = threading.Event()
+
+    def fetch():
+        start = 0
+        began = None
+        try:
+            while not stop.isSet():
+                if began is not None:
+                    stop.wait(began + interval - time.time())
+                began = time.time()
+                page = getBookmarks(username, password, compress,
+                    start=start, results=pageSize)
+                metrics.addTime('fetch', time.time() - began)
+                tags = set()
+                counts = {'posts': 0}
+                objects = list(metrics.timed('parse',
+                    iterParseXml(page, tags, username, counts)))
+                del page
+                if counts['posts']:
+                    put((objects, tags))
+                if counts['posts'] < pageSize:
+                    break
+                start += counts['posts']
+        except Exception as ex:
+            put(ex)
+        put(None)
+
+    def put(item):
+        while not stop.isSet():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+    fetcher = threading.Thread(target=fetch)
+    fetcher.setDaemon(True)
+    fetcher.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                break
+            elif isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+
+
+def iterBookmarks(username, password, tags=None, pageSize=DEFAULT_PAGE_SIZE,
+    compress=True):
+    """
+    Yields dict objects representing the user's delicious bookmarks as each
+    page of them arrives (see iterPages). If tags is a set then every tag used
+    is added to it.
+    """
+    for objects, pageTags in iterPages(username, password, pageSize,
+        compress):
+        if tags is not None:
+            tags.update(pageTags)
+        for obj in objects:
+            yield obj
+
+
+# Maps the attributes of a delicious <post> element to the keys used in the
+# resulting objects. Faffing about to make sure description->title and
+# extended->notes. Ugly hack :-(
+POST_ATTRIBUTES = (
+    ('href', 'href'),
+    ('hash', 'hash'),
+    ('description', 'title'),
+    ('tag', 'tag'),
+    ('time', 'time'),
+    ('extended', 'notes'),
+    ('meta', 'meta'),
+    ('shared', 'shared'),
+)
+
+
+class Bookmark(object):
+    """
+    A compact record of a single delicious bookmark. The fields are held in
+    slots rather than a dict per bookmark and tag names are shared so even
+    hundreds of thousands of them take up little memory.
+
+    Bookmarks behave like the dicts used elsewhere (and by older versions of
+    this script) to represent objects: the fields that are set can be got with
+    bookmark['title'], checked for with 'title' in bookmark and listed by
+    keys().
+    """
+
+    __slots__ = tuple([key for attribute, key in POST_ATTRIBUTES])
+
+    def __init__(self, href=None, hash=None, title=None, tag=None, time=None,
+        notes=None, meta=None, shared=None):
+        self.href = href
+        self.hash = hash
+        self.title = title
+        self.tag = tag
+        self.time = time
+        self.notes = notes
+        self.meta = meta
+        self.shared = shared
+
+    def __getitem__(self, key):
+        value = None
+        if key in self.__slots__:
+            value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __repr__(self):
+        return 'Bookmark(%s)' % ', '.join(['%s=%r' % (key, self[key])
+            for key in self.keys()])
+
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return [key for key in self.__slots__
+            if getattr(self, key) is not None]
+
+
+def iterParseXml(bookmarks, tags=None, source=None, counts=None):
+    """
+    Given the eggsmell in bookmarks (either a string or a file-like object)
+    will incrementally yield Bookmark objects representing the objects to be
+    created in FluidDB, one <post> element at a time. Memory use stays flat
+    no matter how big the export is since each element is discarded as soon
+    as it has been turned into a Bookmark. Each distinct tag name is only held
+    once however many of the bookmarks parsed use it.
+
+    If tags is a set then every tag used in the export is added to it as
+    parsing progresses (including the tags of bookmarks that are not shared).
+
+    The number of bookmarks the export says it holds is expected by the
+    progress tracker (if any) under the given source (the same for every page
+    of one account) and those that are not shared are counted as skipped.
+    If counts is a dict the number of <post> elements parsed (shared or not)
+    is added to counts['posts'].
+    """
+    try:
+        from xml.etree.cElementTree import iterparse
+    except ImportError:
+        from xml.etree.ElementTree import iterparse
+    if isinstance(bookmarks, unicode):
+        bookmarks = bookmarks.encode('utf-8')
+    if isinstance(bookmarks, str):
+        bookmarks = StringIO(bookmarks)
+    root = None
+    # the shared copy of each tag name seen (tags are a bounded set, unlike
+    # free text such as the notes)
+    names = {}
+    for event, element in iterparse(bookmarks, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+                total = element.get('total')
+                if progress is not None and total and total.isdigit():
+                    progress.expect('objects', int(total),
+                        source or id(bookmarks))
+            continue
+        if element.tag != 'post' or root is None:
+            continue
+        if counts is not None:
+            counts['posts'] += 1
+        get = element.get
+        tag = get('tag')
+        if tag is not None:
+            tag = [names.setdefault(name, name) for name in tag.split()]
+        shared = get('shared')
+        obj = Bookmark(get('href'), get('hash'), get('description'), tag,
+            get('time'), get('extended'), get('meta'), shared)
+        # Throw away the elements parsed so far
+        root.clear()
+        # Grab the tags
+        if tags is not None and tag:
+            tags.update(tag)
+        # Ignore any bookmark that isn't to be shared
+        if shared == 'no':
+            if progress is not None:
+                progress.skip('objects')
+            continue
+        yield obj
+
+
 def parseXml(bookmarks):
     """
     Given the eggsmell in bookmarks will return two objects:
         * a set of all tags used
-        * a list of dict objects representing the objects to be created in
-        FluidDB
+        * a list of Bookmark objects representing the objects to be created
+        in FluidDB
     """
-    dom = parseString(bookmarks)
     tags = set()
-    objects = []
-    if dom.firstChild.hasChildNodes():
-        tagNodes = [node for node in dom.firstChild.childNodes
-            if node.nodeName == u'post']
-        for tagNode in tagNodes:
-            obj = {}
-            # Create the object dict
-            for attribute in ['href', 'hash', 'description', 'tag', 'time',
-                'extended', 'meta', 'shared']:
-                if tagNode.hasAttribute(attribute):
-                    # Faffing about to make sure description->title,
-                    # extended->notes and "tag" contains a list. Ugly hack :-(
-                    if attribute == 'description':
-                        key = 'title'
-                    elif attribute == 'extended':
-                        key = 'notes'
-                    else:
-                        key = attribute
-                    if key == 'tag':
-                        obj[key] = tagNode.getAttribute(attribute).split()
-                    else:
-                        obj[key] = tagNode.getAttribute(attribute)
-            # Grab the tags
-            for tag in obj['tag']:
-                tags.add(tag)
-            # Ignore any bookmark that isn't to be shared
-            if 'shared' in obj:
-                if obj['shared'] == 'no':
-                    continue
-            objects.append(obj)
+    objects = list(iterParseXml(bookmarks, tags))
     return tags, objects
 
 
-def createTags(tags, namespace):
+def openExport(path):
+    """
+    Opens the delicious export file at path for reading. Files compressed with
+    gzip or bzip2 are decompressed as they are read (so are never held in
+    memory in their entirety). A path of '-' reads from stdin.
+    """
+    if path == '-':
+        return sys.stdin
+    export = open(path, 'rb')
+    magic = export.read(3)
+    export.close()
+    if magic.startswith('\x1f\x8b'):
+        import gzip
+        return gzip.open(path, 'rb')
+    elif magic == 'BZh':
+        import bz2
+        return bz2.BZ2File(path, 'r')
+    return open(path, 'rb')
+
+
+def iterFiles(paths, tags=None):
+    """
+    Yields dict objects representing the bookmarks in each of the local
+    delicious export files in turn (see openExport and iterParseXml). If tags
+    is a set then every tag used is added to it.
+    """
+    for path in paths:
+        logger.info('Reading bookmarks from %s' % path)
+        export = openExport(path)
+        try:
+            for obj in metrics.timed('parse',
+                iterParseXml(export, tags, path)):
+                yield obj
+        finally:
+            if export is not sys.stdin:
+                export.close()
+
+
+def importFiles(paths, fdb_username, fdb_password, fdb_root, **kw):
+    """
+    Imports the bookmarks in the local delicious export files into FluidDB
+    without going near delicious. Any keyword arguments are passed on to
+    importIntoFluidDB. Returns the number of objects imported.
+    """
+    tags = set()
+    return importIntoFluidDB(tags, iterFiles(paths, tags), fdb_username,
+        fdb_password, fdb_root, **kw)
+
+
+# The ways of deciding which of several bookmarks with the same about value
+# provides the fields of the merged bookmark: the one with the latest time,
+# the first seen or the last seen.
+MERGE_POLICIES = ('latest', 'first', 'last')
+
+
+def mergeBookmarks(objects, about="href", policy='latest'):
+    """
+    Yields the objects with any duplicates (those sharing the same about value)
+    merged into one, so each FluidDB object is only written once rather than
+    once per duplicate with the last write winning. A merged object has the
+    union of the tags of its duplicates and the other fields of the duplicate
+    chosen by the policy (see MERGE_POLICIES). Objects are yielded in the order
+    their about value was first seen.
+
+    All the objects are read (and held in memory) before the first is
+    yielded, so nothing can be imported until the whole export has been
+    parsed.
+    """
+    if policy not in MERGE_POLICIES:
+        raise ValueError('Unknown merge policy: %s' % policy)
+    merged = {}
+    order = []
+    duplicates = 0
+    for obj in objects:
+        key = obj[about]
+        existing = merged.get(key)
+        if existing is None:
+            merged[key] = obj
+            order.append(key)
+            continue
+        duplicates += 1
+        if progress is not None:
+            progress.skip('objects')
+        tags = list(existing.get('tag') or [])
+        tags.extend([tag for tag in obj.get('tag') or [] if tag not in tags])
+        if policy == 'last' or (policy == 'latest' and
+            (obj.get('time') or '') > (existing.get('time') or '')):
+            merged[key] = existing = obj
+        existing['tag'] = tags
+    logger.info('Merged %d duplicate bookmarks' % duplicates)
+    for key in order:
+        yield merged.pop(key)
+
+
+# The file recording what has been successfully written to FluidDB so an
+# import can be resumed.
+JOURNAL_FILENAME = 'd2f.journal'
+
+
+class Journal(object):
+    """
+    An append-only record of the namespaces, tags and objects that have been
+    successfully written to FluidDB. Each entry is a JSON encoded [kind, key]
+    list on a line of its own and is flushed to disk as soon as it is
+    recorded, so if an import dies part way through it can be restarted with
+    resume=True and only the remaining work is done.
+
+    Without resume any existing journal at path is started afresh.
+    """
+
+    def __init__(self, path=JOURNAL_FILENAME, resume=False):
+        self.path = path
+        self._done = set()
+        self._lock = threading.Lock()
+        if resume and os.path.exists(path):
+            journal = open(path, 'r')
+            for line in journal:
+                try:
+                    kind, key = json.loads(line)
+                except ValueError:
+                    # a partially written entry from a crash
+                    continue
+                self._done.add((kind, key))
+            journal.close()
+            logger.info('Resuming from %d journal entries in %s' %
+                (len(self._done), path))
+        self._file = open(path, resume and 'a+' or 'w')
+        if resume and os.path.getsize(path):
+            # make sure new entries don't follow on from a torn one
+            self._file.seek(-1, os.SEEK_END)
+            if self._file.read(1) != '\n':
+                self._file.write('\n')
+
+    def __len__(self):
+        return len(self._done)
+
+    def done(self, kind, key):
+        """
+        Returns a boolean to indicate if the item identified by kind and key
+        has already been written to FluidDB.
+        """
+        return (kind, key) in self._done
+
+    def record(self, kind, key):
+        """
+        Records that the item identified by kind and key has been written to
+        FluidDB.
+        """
+        self._lock.acquire()
+        try:
+            if (kind, key) not in self._done:
+                self._done.add((kind, key))
+                self._file.write(json.dumps([kind, key]) + '\n')
+                self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        Makes sure everything recorded is on disk and closes the journal.
+        """
+        self._lock.acquire()
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        finally:
+            self._lock.release()
+
+
+# The file holding the index of bookmarks imported by the last sync.
+SYNC_INDEX_FILENAME = 'd2f.index'
+
+
+class SyncIndex(object):
+    """
+    A local index of the bookmarks imported by previous runs, mapping each
+    bookmark's about value to its delicious hash, meta and tags. Delicious
+    changes the meta attribute whenever a bookmark is edited so only those
+    bookmarks that are new or whose hash or meta have changed since the last
+    run need to be pushed to FluidDB.
+
+    Call changed() to filter the objects being imported, commit() once the
+    import has finished and save() to write the index back to disk.
+    """
+
+    def __init__(self, path=SYNC_INDEX_FILENAME, about="href"):
+        self.path = path
+        self.about = about
+        self.entries = {}
+        self._pending = {}
+        self._seen = set()
+        if os.path.exists(path):
+            index = open(path, 'r')
+            self.entries = json.load(index)
+            index.close()
+        logger.info('Loaded %d bookmarks from the sync index %s' %
+            (len(self.entries), path))
+
+    def changed(self, objects):
+        """
+        Yields only those objects that are new or have changed since they were
+        last imported.
+        """
+        unchanged = 0
+        for obj in objects:
+            key = obj[self.about]
+            self._seen.add(key)
+            entry = [obj.get('hash'), obj.get('meta'), obj.get('tag', [])]
+            if self.entries.get(key, [None, None])[:2] == entry[:2]:
+                unchanged += 1
+                if progress is not None:
+                    progress.skip('objects')
+                continue
+            self._pending[key] = entry
+            yield obj
+        logger.info('%d bookmarks are unchanged since the last sync' %
+            unchanged)
+
+    def deleted(self):
+        """
+        Returns a dict of the index entries for the bookmarks that were not
+        seen by changed(). Only meaningful once all the objects have been
+        filtered.
+        """
+        return dict((key, entry) for key, entry in self.entries.iteritems()
+            if key not in self._seen)
+
+    def commit(self, journal=None):
+        """
+        Updates the index with the objects yielded by changed(). If a journal
+        is given only those objects it records as imported are committed so
+        that failures are retried by the next sync.
+        """
+        for key, entry in self._pending.iteritems():
+            if journal is not None:
+                if not journal.done('object', entry[0] or key):
+                    continue
+            self.entries[key] = entry
+        self._pending = {}
+
+    def forget(self, keys):
+        """
+        Removes the given keys from the index.
+        """
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def save(self):
+        """
+        Writes the index to disk, replacing the previous version only once the
+        new one is complete.
+        """
+        temp = self.path + '.tmp'
+        index = open(temp, 'w')
+        json.dump(self.entries, index)
+        index.close()
+        os.rename(temp, self.path)
+
+
+# How long (in seconds) the namespaces and tags known to exist in FluidDB are
+# remembered in the on-disk existence cache.
+DEFAULT_CACHE_TTL = 60 * 60
+
+
+class ExistenceCache(object):
+    """
+    Remembers which tags and child namespaces exist under each namespace in
+    FluidDB so only missing ones need to be created. The contents of a
+    namespace are listed with a single GET the first time it is consulted. If
+    that fails the namespace's contents are treated as unknown for the rest
+    of the run rather than being listed again.
+
+    If a path is given the cache is also loaded from and saved to that file,
+    ignoring namespaces listed more than ttl seconds ago.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lookups = 0
+        self._namespaces = {}
+        self._unknown = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            cache = open(path, 'r')
+            now = time.time()
+            for namespace, entry in json.load(cache).iteritems():
+                if now - entry['time'] < ttl:
+                    self._namespaces[namespace] = {'time': entry['time'],
+                        'tags': set(entry['tags']),
+                        'namespaces': set(entry['namespaces'])}
+            cache.close()
+
+    def _entry(self, namespace):
+        """
+        Returns the cached contents of the namespace, listing them from
+        FluidDB if needed. Returns None if the contents can't be found out.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._namespaces.get(namespace)
+            if entry is None and namespace in self._unknown:
+                return None
+        finally:
+            self._lock.release()
+        if entry is None:
+            self.lookups += 1
+            try:
+                response, result = backend.listNamespace(namespace)
+            except Exception as ex:
+                if not recoverable(ex):
+                    raise
+                response, result = {'status': None}, ex
+            if response['status'] == '200':
+                tags, namespaces = result['tagNames'], result['namespaceNames']
+            elif response['status'] == '404':
+                tags, namespaces = [], []
+            else:
+                logger.warning("Can't list the namespace %s: %s" %
+                    (namespace, response['status'] or result))
+                self._lock.acquire()
+                try:
+                    self._unknown.add(namespace)
+                finally:
+                    self._lock.release()
+                return None
+            self._lock.acquire()
+            try:
+                entry = self._namespaces.setdefault(namespace, {
+                    'time': time.time(), 'tags': set(tags),
+                    'namespaces': set(namespaces)})
+            finally:
+                self._lock.release()
+        return entry
+
+    def hasTag(self, namespace, name):
+        """
+        Returns a boolean to indicate if the named tag exists in the namespace.
+        """
+        entry = self._entry(namespace)
+        return entry is not None and name in entry['tags']
+
+    def hasNamespace(self, parent, name):
+        """
+        Returns a boolean to indicate if the named namespace exists in the
+        parent namespace.
+        """
+        entry = self._entry(parent)
+        return entry is not None and name in entry['namespaces']
+
+    def addTag(self, namespace, name):
+        """
+        Records that the named tag now exists in the namespace.
+        """
+        self._lock.acquire()
+        try:
+            if namespace in self._namespaces:
+                self._namespaces[namespace]['tags'].add(name)
+        finally:
+            self._lock.release()
+
+    def addNamespace(self, parent, name):
+        """
+        Records that the named namespace now exists in the parent namespace
+        (and that it's empty if nothing is known about it).
+        """
+        self._lock.acquire()
+        try:
+            if parent in self._namespaces:
+                self._namespaces[parent]['namespaces'].add(name)
+            self._namespaces.setdefault('/'.join([parent, name]), {
+                'time': time.time(), 'tags': set(), 'namespaces': set()})
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """
+        Writes the cache to disk (if it has a path).
+        """
+        if not self.path:
+            return
+        self._lock.acquire()
+        try:
+            data = dict((namespace, {'time': entry['time'],
+                'tags': list(entry['tags']),
+                'namespaces': list(entry['namespaces'])})
+                for namespace, entry in self._namespaces.iteritems())
+        finally:
+            self._lock.release()
+        cache = open(self.path, 'w')
+        json.dump(data, cache)
+        cache.close()
+
+
+# How often (in seconds) progress is reported and over how many seconds the
+# rate of progress is worked out.
+DEFAULT_PROGRESS_INTERVAL = 10.0
+DEFAULT_PROGRESS_WINDOW = 30.0
+
+
+class Progress(object):
+    """
+    Tracks how far through each kind of work (tags, objects) an import is:
+    how many items are expected, how many have been imported, have failed or
+    were skipped (because they already exist, are duplicates or unchanged),
+    the rate items have been dealt with over the last window seconds, the
+    error rate and the estimated time left.
+
+    Progress is logged every interval seconds and, if a path is given, also
+    written there as JSON (replacing the previous report in one go) for other
+    tools to poll. If a name is given (e.g. of the account being migrated)
+    it's included in every line logged.
+    """
+
+    def __init__(self, interval=DEFAULT_PROGRESS_INTERVAL,
+        window=DEFAULT_PROGRESS_WINDOW, path=None, name=None):
+        self.interval = interval
+        self.window = window
+        self.path = path
+        self.name = name
+        self.started = time.time()
+        self._kinds = {}
+        self._lastReport = self.started
+        self._lock = threading.Lock()
+
+    def _kind(self, kind):
+        """
+        Returns the counts for the kind of work, creating them if needed.
+        Call with the lock held.
+        """
+        counts = self._kinds.get(kind)
+        if counts is None:
+            import collections
+            counts = self._kinds[kind] = {'totals': {}, 'expected': 0,
+                'imported': 0, 'failed': 0, 'skipped': 0,
+                'started': time.time(), 'recent': collections.deque()}
+        return counts
+
+    def expect(self, kind, count, source=None):
+        """
+        Adds count items to the number of the kind expected. If a source is
+        given (e.g. an export file) the count replaces any previously
+        expected from the same source.
+        """
+        self._lock.acquire()
+        try:
+            counts = self._kind(kind)
+            if source is None:
+                counts['expected'] += count
+            else:
+                counts['totals'][source] = count
+        finally:
+            self._lock.release()
+
+    def record(self, kind, ok=True):
+        """
+        Records that an item of the kind was imported (or failed if ok is
+        false).
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            counts = self._kind(kind)
+            counts[ok and 'imported' or 'failed'] += 1
+            counts['recent'].append(now)
+        finally:
+            self._lock.release()
+        self._due(now)
+
+    def skip(self, kind, count=1):
+        """
+        Records that count items of the kind were skipped.
+        """
+        self._lock.acquire()
+        try:
+            self._kind(kind)['skipped'] += count
+        finally:
+            self._lock.release()
+
+    def stats(self, kind):
+        """
+        Returns a dict of the progress of the kind of work.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            counts = self._kind(kind)
+            recent = counts['recent']
+            while recent and recent[0] < now - self.window:
+                recent.popleft()
+            elapsed = min(self.window, now - counts['started'])
+            done = counts['imported'] + counts['failed']
+            stats = {'imported': counts['imported'],
+                'failed': counts['failed'], 'skipped': counts['skipped'],
+                'completed': done + counts['skipped'],
+                'total': counts['expected'] + sum(counts['totals'].values()),
+                'perSecond': len(recent) / max(elapsed, 0.001),
+                'errorRate': done and counts['failed'] / float(done) or 0.0}
+        finally:
+            self._lock.release()
+        stats['total'] = max(stats['total'], stats['completed']) or None
+        stats['eta'] = None
+        if stats['total'] and stats['perSecond']:
+            stats['eta'] = ((stats['total'] - stats['completed']) /
+                stats['perSecond'])
+        return stats
+
+    def report(self):
+        """
+        Returns a dict of the progress of each kind of work, suitable for JSON
+        encoding.
+        """
+        return {'time': time.time(), 'seconds': time.time() - self.started,
+            'progress': dict((kind, self.stats(kind))
+                for kind in sorted(self._kinds))}
+
+    def summary(self, kind):
+        """
+        Returns a line summarising the progress of the kind of work for
+        people to read.
+        """
+        stats = self.stats(kind)
+        line = '%s: %d' % (kind, stats['completed'])
+        if self.name:
+            line = '%s %s' % (self.name, line)
+        if stats['total']:
+            line += '/%d (%.1f%%)' % (stats['total'],
+                100.0 * stats['completed'] / stats['total'])
+        line += ', %.1f/sec, %.1f%% failed' % (stats['perSecond'],
+            100 * stats['errorRate'])
+        if stats['eta'] is not None:
+            line += ', %dm%02ds left' % divmod(int(stats['eta']), 60)
+        return line
+
+    def _due(self, now):
+        """
+        Reports progress if it's been interval seconds since it last was.
+        """
+        if now - self._lastReport < self.interval:
+            return
+        self._lock.acquire()
+        try:
+            if now - self._lastReport < self.interval:
+                return
+            self._lastReport = now
+        finally:
+            self._lock.release()
+        self.show()
+
+    def show(self):
+        """
+        Logs the progress of each kind of work and writes it to the status
+        file (if any).
+        """
+        for kind in sorted(self._kinds):
+            logger.info(self.summary(kind))
+        if self.path:
+            status = open(self.path + '.tmp', 'w')
+            json.dump(self.report(), status, indent=2, sort_keys=True)
+            status.close()
+            os.rename(self.path + '.tmp', self.path)
+
+
+# The progress of an import is tracked if progress is set to a Progress.
+progress = None
+
+
+def objectKey(obj, about="href"):
+    """
+    Returns the key used to identify an object in the journal: the delicious
+    hash of the bookmark or, failing that, its about value.
+    """
+    return obj.get('hash') or obj[about]
+
+
+def createTag(namespace, name, description, journal=None, cache=None):
+    """
+    Creates the named tag under the given namespace unless the journal or the
+    existence cache says it already exists. Returns a boolean to indicate if
+    the tag now exists.
+    """
+    path = '/'.join([namespace, name])
+    if journal is not None and journal.done('tag', path):
+        return True
+    if cache is not None and cache.hasTag(namespace, name):
+        return True
+    response = backend.createTag(namespace, name, description)
+    objectLogger.debug(response)
+    if not succeeded(response[0], 412):
+        return False
+    if journal is not None:
+        journal.record('tag', path)
+    if cache is not None:
+        cache.addTag(namespace, name)
+    return True
+
+
+def tagExists(namespace, name, journal=None, cache=None):
+    """
+    Returns a boolean to indicate if the journal or existence cache (if given)
+    know the named tag exists in the namespace.
+    """
+    return ((journal is not None and
+        journal.done('tag', '/'.join([namespace, name]))) or
+        (cache is not None and cache.hasTag(namespace, name)))
+
+
+def createTags(tags, namespace, journal=None, cache=None, workers=1):
     """
     Given a set of tags from delicious will create equivalent tags in FluidDB
-    under the given namespace.
+    under the given namespace. Tags the journal or existence cache know about
+    are skipped and the rest are created concurrently by up to workers
+    threads.
     """
     logger.info('Importing %d tags' % len(tags))
-    for tag in tags:
-        logger.info('Importing %s' % tag)
-        url = '/'.join(['/tags', namespace])
-        logger.debug(call('POST', url, {'name': tag,
-            'description': 'A tag created in delicious & imported to FluidDB',
-            'indexed': False}))
+    # weed out existing tags up front so the namespace is only listed once
+    missing = [tag for tag in sorted(tags)
+        if not tagExists(namespace, tag, journal, cache)]
+    if len(missing) < len(tags):
+        logger.info('%d tags already exist' % (len(tags) - len(missing)))
+    if progress is not None:
+        progress.expect('tags', len(tags))
+        progress.skip('tags', len(tags) - len(missing))
+
+    def create(tag):
+        objectSampler.sample()
+        objectLogger.info('Importing %s', tag)
+        created = False
+        try:
+            created = createTag(namespace, tag,
+                'A tag created in delicious & imported to FluidDB', journal,
+                cache)
+        finally:
+            if progress is not None:
+                progress.record('tags', created)
+    runConcurrently(create, missing, min(workers, len(missing)))
 
 
-def createObjects(objects, namespace, about="href"):
+def recoverable(error):
     """
-    Given a list of object dicts will make sure a corresponding object is
+    Returns a boolean to indicate if an error raised whilst processing one
+    item (see runConcurrently) need only cost that item: a network error that
+    outlasted the retries. Anything else, such as not being able to find the
+    host or a bug, would only happen again for every other item.
+    """
+    _http()
+    return (isinstance(error, (socket.error, httplib.HTTPException)) and
+        not isinstance(error, socket.gaierror))
+
+
+def runConcurrently(function, items, workers=1, maxInFlight=None):
+    """
+    Calls function with each of the items using a pool of worker threads and
+    returns the number of calls that completed without raising an exception.
+    A recoverable exception (see recoverable) is logged and the remaining
+    items are still processed. Any other exception stops any more items being
+    taken and is raised once the workers have finished.
+
+    Items are pulled from the iterable on the calling thread and queued for the
+    workers. At most maxInFlight (defaulting to twice the number of workers)
+    items are queued or being processed at any one time so a generator is only
+    consumed as fast as the workers can keep up. With a single worker the
+    items are processed in order on the calling thread.
+    """
+    if workers <= 1:
+        done = 0
+        for item in items:
+            try:
+                function(item)
+                done += 1
+            except Exception as ex:
+                if not recoverable(ex):
+                    raise
+                logger.exception('Problem processing %r' % (item, ))
+        return done
+    if not maxInFlight:
+        maxInFlight = workers * 2
+    queue = Queue.Queue(max(maxInFlight - workers, 1))
+    lock = threading.Lock()
+    results = {'done': 0, 'failure': None}
+    sentinel = object()
+
+    def work():
+        while True:
+            item = queue.get()
+            if item is sentinel:
+                break
+            if results['failure'] is not None:
+                # drop what's already queued
+                continue
+            try:
+                function(item)
+                lock.acquire()
+                try:
+                    results['done'] += 1
+                finally:
+                    lock.release()
+            except Exception as ex:
+                if recoverable(ex):
+                    logger.exception('Problem processing %r' % (item, ))
+                    continue
+                lock.acquire()
+                try:
+                    if results['failure'] is None:
+                        results['failure'] = sys.exc_info()
+                finally:
+                    lock.release()
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for item in items:
+            if results['failure'] is not None:
+                break
+            queue.put(item)
+    finally:
+        for thread in threads:
+            queue.put(sentinel)
+        for thread in threads:
+            thread.join()
+    failure = results['failure']
+    if failure is not None:
+        raise failure[0], failure[1], failure[2]
+    return results['done']
+
+
+# The value given to each delicious tag on an object. Shared rather than
+# created for every tag on every object.
+NO_VALUE = {"value": None}
+
+
+class TagPaths(object):
+    """
+    Builds the full paths of the tags under a namespace that represent the
+    fields and delicious tags of bookmarks and remembers them, so the paths
+    aren't joined together afresh for every bookmark. The paths of the
+    endpoints used to create and list the contents of the namespace are
+    built up front.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        # where to POST to create tags and namespaces in the namespace and
+        # GET its contents
+        self.tags = '/tags/' + namespace
+        self.namespaces = '/namespaces/' + namespace
+        self._fields = {}
+        self._tags = {}
+
+    def field(self, key):
+        """
+        Returns the path of the tag holding the named field: title and notes
+        live in the namespace, everything else in its delicious namespace.
+        """
+        path = self._fields.get(key)
+        if path is None:
+            if key in ['title', 'notes']:
+                path = '/'.join([self.namespace, key])
+            else:
+                path = '/'.join([self.namespace, 'delicious', key])
+            self._fields[key] = path
+        return path
+
+    def tag(self, name):
+        """
+        Returns the path of the tag representing the named delicious tag.
+        """
+        path = self._tags.get(name)
+        if path is None:
+            path = self._tags[name] = '/'.join([self.namespace, name])
+        return path
+
+
+_tagPaths = {}
+
+
+def tagPaths(namespace):
+    """
+    Returns the (shared) TagPaths for the namespace.
+    """
+    paths = _tagPaths.get(namespace)
+    if paths is None:
+        paths = _tagPaths.setdefault(namespace, TagPaths(namespace))
+    return paths
+
+
+# Defaults for batching the values of objects into a single PUT to /values.
+# The query length is the combined length of the queries in a batch.
+DEFAULT_BATCH_SIZE = 50
+MAX_QUERY_LENGTH = 2000
+
+
+def aboutQuery(about):
+    """
+    Returns the FluidDB query that identifies the object with the given about
+    tag value.
+    """
+    about = about.replace('\\', '\\\\').replace('"', '\\"')
+    return 'fluiddb/about="%s"' % about
+
+
+class ValueBatcher(object):
+    """
+    Collects the values to set on objects so those of many objects can be
+    set with a single PUT to /values carrying a [query, values] pair per
+    object. A batch is sent once it holds batchSize objects or its queries
+    would grow beyond maxQueryLength characters. Call flush() to send the
+    remaining batch.
+
+    Only add objects that already exist in FluidDB since their queries won't
+    match anything that hasn't been created yet. If a journal is given the
+    objects in a batch are recorded in it once their values have been set.
+    The outcome for each object is given to the progress tracker (if any) and
+    the number of objects successfully tagged is kept in tagged.
+    """
+
+    def __init__(self, batchSize=DEFAULT_BATCH_SIZE,
+        maxQueryLength=MAX_QUERY_LENGTH, journal=None):
+        self.journal = journal
+        self.batchSize = batchSize
+        self.maxQueryLength = maxQueryLength
+        self.requests = 0
+        self.tagged = 0
+        self._batch = []
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def add(self, query, values, key=None):
+        """
+        Adds the values to set on the object matching the query (recorded in
+        the journal under key), sending the batch if it's full.
+        """
+        ready = None
+        self._lock.acquire()
+        try:
+            if self._batch and (len(self._batch) >= self.batchSize or
+                self._length + len(query) > self.maxQueryLength):
+                ready = self._batch
+                self._batch, self._length = [], 0
+            self._batch.append((query, values, key))
+            self._length += len(query)
+        finally:
+            self._lock.release()
+        if ready:
+            self.put(ready)
+
+    def flush(self):
+        """
+        Sends the outstanding batch.
+        """
+        self._lock.acquire()
+        try:
+            ready = self._batch
+            self._batch, self._length = [], 0
+        finally:
+            self._lock.release()
+        if ready:
+            self.put(ready)
+
+    def put(self, batch):
+        """
+        Sets the values on the objects matched by the (query, values, key)
+        tuples in the batch.
+        """
+        objectSampler.sample()
+        objectLogger.info('Tagging %d objects', len(batch))
+        self.requests += 1
+        try:
+            response = backend.setBatchValues([[query, values]
+                for query, values, key in batch])
+            objectLogger.debug(response)
+            ok = succeeded(response[0])
+        except Exception as ex:
+            if not recoverable(ex):
+                raise
+            logger.exception('Problem tagging %d objects' % len(batch))
+            ok = False
+        if not ok:
+            logger.error('Failed to tag %d objects' % len(batch))
+        else:
+            self._lock.acquire()
+            try:
+                self.tagged += len(batch)
+            finally:
+                self._lock.release()
+            if self.journal is not None:
+                for query, values, key in batch:
+                    self.journal.record('object', key)
+        if progress is not None:
+            for item in batch:
+                progress.record('objects', ok)
+
+
+def createObject(obj, namespace, about="href", batcher=None, journal=None):
+    """
+    Creates (or gets) the object representing a single bookmark in FluidDB and
+    then tags it with the bookmark's fields and delicious tags.
+
+    If a ValueBatcher is given the values are left to it to set along with
+    those of other objects rather than with a PUT to /values of the object's
+    own. Otherwise the object is recorded in the journal (if given) once it
+    has been tagged. Returns a boolean to indicate if the object was tagged,
+    or None if it was handed to the batcher (which reports how it went).
+    """
+    objectSampler.sample()
+    objectLogger.info('Creating/getting object about: %s', obj[about])
+    objectLogger.debug(backend.createObject(obj[about]))
+    objectLogger.info('Adding metadata fields to the object.')
+    # query to identify the object we're interested in
+    query = aboutQuery(obj[about])
+    # build the dict that defines the values to tag
+    paths = tagPaths(namespace)
+    payload = {}
+    for key in obj.keys():
+        if key == 'href':
+            # ignore 'href' as it's the about tag value
+            continue
+        payload[paths.field(key)] = {"value": obj[key]}
+    for tag in obj['tag']:
+        payload[paths.tag(tag)] = NO_VALUE
+    if batcher:
+        batcher.add(query, payload, objectKey(obj, about))
+        return None
+    response = backend.setValues(query, payload)
+    objectLogger.debug(response)
+    if not succeeded(response[0]):
+        return False
+    if journal is not None:
+        journal.record('object', objectKey(obj, about))
+    return True
+
+
+def createObjects(objects, namespace, about="href", knownTags=None,
+    workers=1, maxInFlight=None, batchSize=1, journal=None, cache=None):
+    """
+    Given a list (or any other iterable, such as the generator returned by
+    iterParseXml) of object dicts will make sure a corresponding object is
     created and tagged appropriately in FluidDB. The namespace argument is used
     to indicate where the tags representing the object's fields are to be
     created. The about argument references the field to use as the unique
     value for the about tag of each object.
+
+    If knownTags is a set of the delicious tags that already exist in FluidDB
+    then any tag not in it is created (and added to it) before the first
+    object that uses it is tagged. This allows objects to be imported whilst
+    the export is still being parsed.
+
+    Objects are imported by workers threads with no more than maxInFlight
+    objects outstanding at once (see runConcurrently). Each object is always
+    created before it is tagged, but different objects proceed in parallel.
+
+    If batchSize is greater than one then the values of up to batchSize
+    objects are set with each request (see ValueBatcher).
+
+    If a journal is given, objects (and tags) it records as already imported
+    are skipped and newly imported ones are recorded in it. If an
+    ExistenceCache is given only the tags it doesn't know about are created.
+    Returns the number of objects imported.
     """
+    if (progress is not None and hasattr(objects, '__len__') and
+        not progress.stats('objects')['total']):
+        progress.expect('objects', len(objects))
+    objects = iter(objects)
+    try:
+        first = objects.next()
+    except StopIteration:
+        logger.info('No objects to create')
+        return 0
     logger.info('Creating tags for object fields')
-    for key in objects[0].keys():
-        url = '/'.join(['/tags', namespace])
+    fields = []
+    for key in first.keys():
+        parent = namespace
         if key == 'href':
             # ignore href since its the value of the about tag
             continue
         elif not key in ['title', 'notes']:
-            url = '/'.join([url, 'delicious'])
-        logger.debug(call('POST', url, {'name': key,
-            'description': 'A tag generated from meta-data from delicious',
-            'indexed': False}))
-    logger.info('Creating/tagging %d objects' % len(objects))
-    for obj in objects:
-        logger.info('Creating/getting object about: %s' % obj[about])
-        logger.debug(call('POST', '/objects', {'about': obj[about]}))
-        logger.info('Adding metadata fields to the object.')
-        # query to identify the object we're interested in
-        query = 'fluiddb/about="%s"' % obj[about]
-        # build the dict that defines the values to tag
-        payload = {}
-        for key in obj.keys():
-            if key == 'href':
-                # ignore 'href' as it's the about tag value
+            parent = '/'.join([namespace, 'delicious'])
+        if not tagExists(parent, key, journal, cache):
+            fields.append((parent, key))
+    runConcurrently(lambda field: createTag(field[0], field[1],
+        'A tag generated from meta-data from delicious', journal, cache),
+        fields, min(workers, len(fields)))
+
+    def pending():
+        """
+        Yields the objects not yet imported, creating any previously unseen
+        delicious tags before the object using them is handed to a worker.
+        """
+        skipped = 0
+        for obj in itertools.chain([first], objects):
+            key = objectKey(obj, about)
+            if journal is not None and journal.done('object', key):
+                skipped += 1
+                if progress is not None:
+                    progress.skip('objects')
                 continue
-            elif not key in ['title', 'notes']:
-                path = '/'.join([namespace, 'delicious', key])
-            else:
-                path = '/'.join([namespace, key])
-            value = {"value": obj[key]}
-            payload[path] = value
-        for tag in obj['tag']:
-            path = '/'.join([namespace, tag])
-            value = {"value": None}
-            payload[path] = value
-        logger.debug(call('PUT', '/values', payload, query=query))
+            if knownTags is not None:
+                newTags = set(obj.get('tag', [])) - knownTags
+                if newTags:
+                    createTags(newTags, namespace, journal, cache, workers)
+                    knownTags.update(newTags)
+            yield obj
+        if skipped:
+            logger.info('Skipped %d objects already imported' % skipped)
+    batcher = None
+    if batchSize > 1:
+        batcher = ValueBatcher(batchSize, journal=journal)
+    logger.info('Creating/tagging objects with %d worker(s)' % workers)
+    start = time.time()
+
+    imported = {'count': 0}
+    lock = threading.Lock()
+
+    def importObject(obj):
+        tagged = False
+        try:
+            tagged = createObject(obj, namespace, about, batcher, journal)
+        finally:
+            # a batched object is reported once its batch has been sent
+            if progress is not None and tagged is not None:
+                progress.record('objects', tagged)
+        if tagged:
+            lock.acquire()
+            try:
+                imported['count'] += 1
+            finally:
+                lock.release()
+    runConcurrently(importObject, pending(), workers, maxInFlight)
+    count = imported['count']
+    if batcher:
+        batcher.flush()
+        count += batcher.tagged
+        logger.info('Tagged objects with %d batched requests' %
+            batcher.requests)
+    elapsed = time.time() - start
+    logger.info('Created/tagged %d objects in %.2fs (%.2f objects/sec)' %
+        (count, elapsed, count / max(elapsed, 0.001)))
+    if progress is not None:
+        progress.show()
+    return count
+
+
+def removeObjects(entries, namespace):
+    """
+    Given a dict of sync index entries for bookmarks that have been deleted
+    from delicious will remove the tags the import added to the corresponding
+    objects in FluidDB. The objects themselves remain (objects in FluidDB are
+    never deleted).
+    """
+    logger.info('Removing tags from %d deleted bookmarks' % len(entries))
+    paths = tagPaths(namespace)
+    fields = [paths.field(key) for attribute, key in POST_ATTRIBUTES
+        if key not in ['href', 'shared']]
+    for about, (hash, meta, tags) in entries.iteritems():
+        objectSampler.sample()
+        objectLogger.info('Removing tags from object about: %s', about)
+        objectLogger.debug(backend.removeValues(aboutQuery(about),
+            fields + [paths.tag(tag) for tag in tags]))
+
+
+def createNamespace(parent, path, journal=None, cache=None):
+    """
+    Creates a namespace path (a list of namespace names) under the parent
+    namespace. Namespaces the journal or existence cache (if given) know about
+    are skipped.
+    """
+    createNamespaces(parent, [path], journal, cache)
+
 
+def createNamespaces(parent, paths, journal=None, cache=None, workers=1):
+    """
+    Creates the tree of namespaces under the parent namespace made up of the
+    given paths (each a list of namespace names) a level at a time. The
+    namespaces at each level that the journal or existence cache (if given)
+    don't know about are created concurrently by up to workers threads.
+    """
+    levels = {}
+    for path in paths:
+        for depth in range(1, len(path) + 1):
+            levels.setdefault(depth, set()).add(tuple(path[:depth]))
+    for depth in sorted(levels):
+        missing = []
+        for path in sorted(levels[depth]):
+            namespace = '/'.join((parent, ) + path[:-1])
+            if journal is not None and journal.done('namespace',
+                '/'.join([namespace, path[-1]])):
+                continue
+            if cache is not None and cache.hasNamespace(namespace, path[-1]):
+                continue
+            missing.append((namespace, path[-1]))
+        runConcurrently(lambda item: createChildNamespace(item[0], item[1],
+            journal, cache), missing, min(workers, len(missing)))
 
-def createNamespace(parent, path):
+
+def createChildNamespace(parent, name, journal=None, cache=None):
     """
-    Recursively creates a namespace path from a list of namespaces
+    Creates the named namespace in the parent namespace.
     """
-    if path:
-        logger.debug(call('POST', '/namespaces/%s' % parent,
-            {'name': path[0],
-            'description': 'Holds tags imported from delicious'}))
-        createNamespace('/'.join([parent, path[0]]), path[1:])
+    response = backend.createNamespace(parent, name,
+        'Holds tags imported from delicious')
+    logger.debug(response)
+    if succeeded(response[0], 412):
+        if journal is not None:
+            journal.record('namespace', '/'.join([parent, name]))
+        if cache is not None:
+            cache.addNamespace(parent, name)
 
 
-def importIntoFluidDB(tags, objects, fdb_username, fdb_password, fdb_root):
+def importIntoFluidDB(tags, objects, fdb_username, fdb_password, fdb_root,
+    workers=1, maxInFlight=None, batchSize=1, journal=None, cache=None):
     """
     Sets up the correct state in FluidDB for the import of the tags from
     delicious
+
+    The objects can be a list or a generator from iterParseXml, in which case
+    tags need only contain the tags known so far (any others are created as
+    they are encountered).
+
+    The workers and maxInFlight arguments tune how many objects are imported
+    concurrently (see createObjects). The connection pool is grown so each
+    worker has its own connection. If batchSize is greater than one the
+    values of up to that many objects are set with each request.
+
+    If a Journal is given then work it records as done is skipped and new
+    work is recorded in it, so a failed import can be resumed. If an
+    ExistenceCache is given only the namespaces and tags missing from FluidDB
+    are created.
+
+    Returns the number of objects imported.
     """
+    if workers > pool.size:
+        configurePool(workers, pool.timeout)
     # set up things in FluidDB
     logger.info('Creating delicious namespace in FluidDB')
     login(fdb_username, fdb_password)
-    if fdb_root == fdb_username:
-        # create the delicious namespace
-        createNamespace(fdb_root, ['delicious', ])
-    else:
-        # not importing to the user's root namespace so create the bespoke
-        # namespace path.
-        path = fdb_root.split('/')
-        path.append('delicious')
-        createNamespace(path[0], path[1:])
-    createTags(tags, fdb_root)
-    createObjects(objects, fdb_root)
+    with metrics.phase('namespace'):
+        if fdb_root == fdb_username:
+            # create the delicious namespace
+            createNamespaces(fdb_root, [['delicious', ]], journal, cache,
+                workers)
+        else:
+            # not importing to the user's root namespace so create the bespoke
+            # namespace path.
+            path = fdb_root.split('/')
+            path.append('delicious')
+            createNamespaces(path[0], [path[1:]], journal, cache, workers)
+    with metrics.phase('tags'):
+        createTags(tags, fdb_root, journal, cache, workers)
+    with metrics.phase('objects'):
+        return createObjects(objects, fdb_root, knownTags=set(tags),
+            workers=workers, maxInFlight=maxInFlight, batchSize=batchSize,
+            journal=journal, cache=cache)
 
 
-def run():
+def migrateAccount(job):
+    """
+    Migrates the bookmarks of a single account. The job is a tuple of a dict
+    describing the account (as found in a manifest, see migrateAccounts) and
+    a dict of settings shared by all the accounts. Returns a dict summarising
+    the outcome rather than raising an exception.
+
+    Since the authentication details, connection pool and statistics are all
+    held at module level each account must be migrated in a process of its
+    own. The account's progress is tracked by a Progress of its own whose
+    lines are logged under the account's name, and its final report is
+    included in the summary.
+    """
+    global instance, progress
+    account, settings = job
+    root = account.get('fluiddbRoot') or account['fluiddbUser']
+    name = account.get('name', root)
+    result = {'account': name, 'objects': 0, 'error': None}
+    start = time.time()
+    progress = Progress(settings.get('progressInterval',
+        DEFAULT_PROGRESS_INTERVAL), name=name)
+    try:
+        instance = settings.get('instance', instance)
+        retryPolicy.maxRetries = settings.get('retries',
+            retryPolicy.maxRetries)
+        logger.info('Migrating %s into %s' % (name, root))
+        journal = Journal(account.get('journal') or
+            'd2f-%s.journal' % root.replace('/', '-'),
+            settings.get('resume', False))
+        tags = set()
+        if account.get('files'):
+            objs = iterFiles(account['files'], tags)
+        else:
+            objs = iterBookmarks(account['deliciousUser'],
+                account['deliciousPassword'], tags,
+                settings.get('pageSize', DEFAULT_PAGE_SIZE),
+                settings.get('compress', True))
+        if settings.get('merge', 'none') != 'none':
+            objs = mergeBookmarks(objs, policy=settings['merge'])
+        try:
+            result['objects'] = importIntoFluidDB(tags, objs,
+                account['fluiddbUser'], account['fluiddbPassword'], root,
+                workers=settings.get('workers', 1),
+                maxInFlight=settings.get('maxInFlight'),
+                batchSize=settings.get('batchSize', 1), journal=journal,
+                cache=ExistenceCache())
+        finally:
+            journal.close()
+    except Exception as ex:
+        logger.exception('Problem migrating %s' % name)
+        result['error'] = str(ex) or repr(ex)
+    result['seconds'] = time.time() - start
+    result['progress'] = progress.report()['progress']
+    result['retries'] = retryPolicy.retries
+    result['drops'] = retryPolicy.drops
+    # the worker process exits without the logging module flushing
+    async_handler.flush()
+    return result
+
+
+def migrateAccounts(accounts, processes=2, **settings):
+    """
+    Migrates the bookmarks of many accounts at once, each in a worker process
+    of its own with no more than processes running at the same time. Each
+    account is a dict with the following keys:
+
+        fluiddbUser, fluiddbPassword = the FluidDB account to import into
+        fluiddbRoot = (optional) the namespace to import into
+        deliciousUser, deliciousPassword = the delicious account to migrate
+        files = (instead of the delicious account) export files to import
+        name = (optional) the name to report the account's progress under
+        journal = (optional) the account's journal file
+
+    The settings (instance, workers, maxInFlight, batchSize, pageSize,
+    compress, retries, resume, merge and progressInterval) apply to every
+    account. Each account's progress is logged under its name as it goes and
+    a summary as it finishes. Returns a list of the dicts summarising
+    each migration (see migrateAccount).
+    """
+    import multiprocessing
+    import multiprocessing.util
+    logger.info('Migrating %d accounts with %d processes' %
+        (len(accounts), processes))
+    multiprocessing.util.register_after_fork(async_handler,
+        AsyncHandler.afterFork)
+    workers = multiprocessing.Pool(processes, maxtasksperchild=1)
+    results = []
+    try:
+        jobs = [(account, settings) for account in accounts]
+        for result in workers.imap_unordered(migrateAccount, jobs):
+            results.append(result)
+            if result['error']:
+                outcome = 'failed: %s' % result['error']
+            else:
+                outcome = 'imported %d objects' % result['objects']
+            logger.info('[%d/%d] %s %s in %.2fs' % (len(results),
+                len(accounts), result['account'], outcome, result['seconds']))
+    finally:
+        workers.close()
+        workers.join()
+    return results
+
+
+def addConsoleHandler():
+    """
+    Makes sure the progress of the import is also logged to the console.
+    """
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(log_format)
+    async_handler.targets.append(ch)
+
+
+def parseArgs(argv=None):
+    """
+    Parses the command line options passed to the script.
+    """
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [EXPORT_FILE ...]',
+        description='Imports delicious bookmarks into FluidDB. If any export'
+        ' files (plain, gzip or bzip2 compressed XML) are given they are'
+        ' imported instead of fetching the bookmarks from delicious.'
+        ' Passwords are read from the DELICIOUS_PASSWORD and FLUIDDB_PASSWORD'
+        ' environment variables or asked for.')
+    parser.add_option('-d', '--delicious-user', default=None,
+        dest='deliciousUser', help='delicious username')
+    parser.add_option('-f', '--fluiddb-user', default=None,
+        dest='fluiddbUser', help='FluidDB username')
+    parser.add_option('--fluiddb-root', default=None, dest='fluiddbRoot',
+        help='FluidDB namespace to import into [default: the FluidDB user'
+        "'s root namespace]")
+    parser.add_option('-i', '--instance', default=MAIN,
+        help='FluidDB instance to import into [default: %default]')
+    parser.add_option('-w', '--workers', type='int', default=1,
+        help='number of objects to import concurrently [default: %default]')
+    parser.add_option('--max-in-flight', type='int', default=None,
+        dest='maxInFlight', help='maximum number of objects queued or being'
+        ' imported at once [default: twice the number of workers]')
+    parser.add_option('-b', '--batch-size', type='int', default=1,
+        dest='batchSize', help='number of bookmarks to tag with a single'
+        ' request [default: %default]')
+    parser.add_option('-j', '--journal', default=JOURNAL_FILENAME,
+        help='file recording the progress of the import [default: %default]')
+    parser.add_option('-r', '--resume', action='store_true', default=False,
+        help='skip the work the journal records as already done')
+    parser.add_option('-s', '--sync', action='store_true', default=False,
+        help='only import bookmarks that are new or changed since the last'
+        ' sync')
+    parser.add_option('--index', default=SYNC_INDEX_FILENAME,
+        help='file holding the bookmarks seen by the last sync'
+        ' [default: %default]')
+    parser.add_option('--remove-deleted', action='store_true',
+        default=False, dest='removeDeleted', help='when syncing, remove the'
+        ' tags from bookmarks deleted from delicious since the last sync')
+    parser.add_option('--merge', default='none',
+        choices=MERGE_POLICIES + ('none',), help='how to merge bookmarks of'
+        ' the same URL: keep the fields of the latest, first or last of them'
+        ' (their tags are always combined) or none to import each in turn.'
+        ' Merging reads every bookmark before importing any'
+        ' [default: %default]')
+    parser.add_option('--cache', default=None,
+        help='file to remember the namespaces and tags that exist in FluidDB'
+        ' between runs')
+    parser.add_option('--cache-ttl', type='int', default=DEFAULT_CACHE_TTL,
+        dest='cacheTTL', help='seconds to trust the namespaces and tags'
+        ' remembered in the cache file [default: %default]')
+    parser.add_option('--rate', type='float', default=None,
+        help='maximum number of requests a second to make to FluidDB (slows'
+        ' down further when FluidDB pushes back) [default: no limit]')
+    parser.add_option('--retries', type='int',
+        default=retryPolicy.maxRetries, help='number of times to retry a'
+        ' failed request [default: %default]')
+    parser.add_option('-n', '--dry-run', action='store_true',
+        default=False, dest='dryRun', help="work out the requests the import"
+        " would make (and how long they'd take at --rate) without writing"
+        ' anything to FluidDB')
+    parser.add_option('--diff', action='store_true', default=False,
+        help='when planning, look up what already exists in FluidDB and only'
+        ' plan to create what is missing')
+    parser.add_option('--plan', default=None,
+        help='file to write each planned request to as a line of JSON'
+        ' (implies --dry-run)')
+    parser.add_option('--sink', default=None,
+        help='stage the import in this local file rather than writing it to'
+        ' FluidDB')
+    parser.add_option('--replay', default=None,
+        help='write an import staged with --sink to FluidDB')
+    parser.add_option('--profile', default=os.environ.get('D2F_PROFILE'),
+        help='directory to write CPU and memory profiles of each phase of'
+        ' the import to (also set by the D2F_PROFILE environment variable)')
+    parser.add_option('--status', default=None,
+        help='file to keep up to date with the progress of the import as'
+        ' JSON')
+    parser.add_option('--progress-interval', type='float',
+        default=DEFAULT_PROGRESS_INTERVAL, dest='progressInterval',
+        help='seconds between reports of the progress of the import'
+        ' [default: %default]')
+    parser.add_option('--log-sample', type='int', default=1,
+        dest='logSample', help='only log one in every LOG_SAMPLE of the'
+        ' messages about individual tags and objects (warnings and errors'
+        ' are always logged) [default: %default]')
+    parser.add_option('-m', '--metrics', default=None,
+        help='file to write the timings and request metrics to as JSON')
+    parser.add_option('-p', '--page-size', type='int',
+        default=DEFAULT_PAGE_SIZE, dest='pageSize', help='number of'
+        ' bookmarks to fetch from delicious at a time, or 0 to fetch them all'
+        ' in one go [default: %default]')
+    parser.add_option('--no-gzip', action='store_false', default=True,
+        dest='compress', help="don't ask delicious to compress its responses")
+    parser.add_option('--manifest', default=None,
+        help='JSON file listing many accounts to migrate at once (see'
+        ' migrateAccounts)')
+    parser.add_option('--processes', type='int', default=2,
+        help='number of accounts in the manifest to migrate at the same time'
+        ' [default: %default]')
+    options, args = parser.parse_args(argv)
+    return options, args
+
+
+def run(argv=None):
     """
     Grabs user input and coordinates the calling of the various functions
     required to export from delicious and import into FluidDB.
     """
-    del_username = raw_input("Delicious username: ").strip()
-    del_password = getpass("Delicious password: ").strip()
-    fdb_username = raw_input("FluidDB username: ").strip()
-    fdb_password = getpass("FluidDB password: ").strip()
-    fdb_root = raw_input("FluidDB path (hit return to default to root"\
-        " namespace: %s)" %
-        fdb_username).strip()
+    from getpass import getpass
+    global limiter, instance, planner, backend, profiler, progress
+    options, files = parseArgs(argv)
+    instance = options.instance
+    if options.profile:
+        profiler = Profiler(options.profile)
+    progress = Progress(options.progressInterval, path=options.status)
+    retryPolicy.maxRetries = options.retries
+    objectSampler.every = options.logSample
+    dryRun = options.dryRun or options.plan
+    # nothing is written to FluidDB when planning or staging
+    local = dryRun or options.sink
+    if dryRun:
+        planner = Planner(options.diff, options.plan)
+    elif options.rate:
+        limiter = RateLimiter(options.rate, burst=max(options.workers, 1))
+    if options.manifest:
+        addConsoleHandler()
+        manifest = open(options.manifest, 'r')
+        accounts = json.load(manifest)
+        manifest.close()
+        results = migrateAccounts(accounts, options.processes,
+            instance=options.instance, workers=options.workers,
+            maxInFlight=options.maxInFlight, batchSize=options.batchSize,
+            pageSize=options.pageSize, compress=options.compress,
+            retries=options.retries, resume=options.resume,
+            merge=options.merge, progressInterval=options.progressInterval)
+        failed = [result['account'] for result in results if result['error']]
+        logger.info('Migrated %d accounts, %d failed %s' % (len(results),
+            len(failed), ' '.join(failed)))
+        async_handler.flush()
+        return
+    if not (files or options.replay):
+        del_username = (options.deliciousUser or
+            raw_input("Delicious username: ").strip())
+        del_password = (os.environ.get('DELICIOUS_PASSWORD') or
+            getpass("Delicious password: ").strip())
+    fdb_username = (options.fluiddbUser or
+        raw_input("FluidDB username: ").strip())
+    fdb_password = (os.environ.get('FLUIDDB_PASSWORD') or
+        getpass("FluidDB password: ").strip())
+    fdb_root = options.fluiddbRoot
+    if not (fdb_root or options.fluiddbUser):
+        fdb_root = raw_input("FluidDB path (hit return to default to root"\
+            " namespace: %s)" %
+            fdb_username).strip()
     if not fdb_root:
         fdb_root = fdb_username
-    # console logger handler
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
-    ch.setFormatter(log_format)
-    logger.addHandler(ch)
-    # grab from delicious
-    bookmarks = getBookmarks(del_username, del_password)
-    # parse the eggsmell into something useful
-    tags, objs = parseXml(bookmarks)
-    # import the results into FluidDB
-    importIntoFluidDB(tags, objs, fdb_username, fdb_password, fdb_root)
+    addConsoleHandler()
+    if options.replay:
+        login(fdb_username, fdb_password)
+        with metrics.phase('replay'):
+            replayed = replay(options.replay, workers=options.workers)
+        logger.info('Replayed %s' % ', '.join(['%d %s' % (replayed[kind],
+            kind) for kind in REPLAY_ORDER]))
+    else:
+        if options.sink:
+            backend = LocalSink(options.sink)
+        journal = None
+        if not local:
+            journal = Journal(options.journal, options.resume)
+        if options.sink:
+            # the cache file describes FluidDB rather than what's being staged
+            cache = ExistenceCache()
+        else:
+            cache = ExistenceCache(options.cache, options.cacheTTL)
+        tags = set()
+        if files:
+            # read the eggsmell from the local export files
+            objs = iterFiles(files, tags)
+        elif options.pageSize:
+            # grab from delicious a page at a time, parsing the eggsmell into
+            # something useful as the import progresses
+            objs = iterBookmarks(del_username, del_password, tags,
+                options.pageSize, options.compress)
+        else:
+            # grab everything from delicious
+            with metrics.phase('fetch'):
+                bookmarks = getBookmarks(del_username, del_password,
+                    options.compress)
+            # parse the eggsmell into something useful as the import progresses
+            objs = metrics.timed('parse', iterParseXml(bookmarks, tags))
+        if options.merge != 'none':
+            objs = mergeBookmarks(objs, policy=options.merge)
+        if options.sync:
+            index = SyncIndex(options.index)
+            objs = index.changed(objs)
+        # import the results into FluidDB
+        try:
+            importIntoFluidDB(tags, objs, fdb_username, fdb_password, fdb_root,
+                workers=options.workers, maxInFlight=options.maxInFlight,
+                batchSize=options.batchSize, journal=journal, cache=cache)
+            if options.sync:
+                if options.removeDeleted:
+                    deleted = index.deleted()
+                    removeObjects(deleted, fdb_root)
+                    index.forget(deleted)
+                if not local:
+                    index.commit(journal)
+                    index.save()
+        finally:
+            if dryRun:
+                planner.close()
+            if options.sink:
+                backend.close()
+            if not local:
+                journal.close()
+                cache.save()
+        if dryRun:
+            for line in planner.summary(options.rate):
+                logger.info(line)
+        if options.sink:
+            logger.info('Staged %d operations in %s' % (backend.operations,
+                options.sink))
+    logger.info('Retried %d requests and dropped %d' %
+        (retryPolicy.retries, retryPolicy.drops))
+    logger.info('URL cache: %d hits, %d misses' % (urlCache.hits,
+        urlCache.misses))
+    for line in metrics.summary():
+        logger.info(line)
+    if options.metrics:
+        metrics.export(options.metrics)
     # fin!
     logger.info('Finished! :-)')
+    async_handler.flush()
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for FluidDB used by the tests and benchmarks.
+
+It emulates just enough of the FluidDB API for delicious2fluid to run an
+import against it: the /namespaces, /tags, /objects and /values endpoints.
+Everything is kept in memory. Each response can be delayed by a fixed latency
+and a proportion of requests can be made to fail with a 503 to exercise the
+retry logic.
+
+Counts of the requests handled (by method and endpoint) and of the bytes
+sent and received are available from GET /_stats.
+
+Run it on its own with:
+
+    $ python fakefluiddb.py --port 8000 --latency 0.01 --error-rate 0.05
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urlparse
+import uuid
+from optparse import OptionParser
+
+
+# Matches a single clause of the queries understood by the fake server.
+ABOUT_CLAUSE = re.compile(r'^fluiddb/about\s*=\s*"((?:[^"\\]|\\.)*)"$')
+HAS_CLAUSE = re.compile(r'^has\s+(\S+)$')
+
+
+class FluidDBState(object):
+    """
+    The namespaces, tags, objects and tag values held by the fake server
+    together with the request statistics.
+    """
+
+    def __init__(self, latency=0.0, errorRate=0.0):
+        self.latency = latency
+        self.errorRate = errorRate
+        self.namespaces = set()
+        self.tags = set()
+        self.objects = {}
+        self.values = {}
+        self.stats = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.lock = threading.Lock()
+
+    def count(self, method, endpoint, bytesIn, bytesOut):
+        """
+        Counts a request to the endpoint.
+        """
+        self.lock.acquire()
+        try:
+            key = '%s /%s' % (method, endpoint)
+            self.stats[key] = self.stats.get(key, 0) + 1
+            self.bytesIn += bytesIn
+            self.bytesOut += bytesOut
+        finally:
+            self.lock.release()
+
+    def exists(self, namespace):
+        """
+        Returns a boolean to indicate if the namespace exists. Top level
+        (user) namespaces always exist.
+        """
+        return '/' not in namespace or namespace in self.namespaces
+
+    def query(self, query):
+        """
+        Returns the set of object ids matching the query. Understands the "or"
+        of fluiddb/about="..." and "has path" clauses.
+        """
+        ids = set()
+        for clause in re.split(r'\s+or\s+(?=fluiddb/about|has\s)', query):
+            match = ABOUT_CLAUSE.match(clause.strip())
+            if match:
+                about = re.sub(r'\\(.)', r'\1', match.group(1))
+                if about in self.objects:
+                    ids.add(self.objects[about])
+                continue
+            match = HAS_CLAUSE.match(clause.strip())
+            if match:
+                path = match.group(1)
+                ids.update(id for (id, tag) in self.values if tag == path)
+                continue
+            raise ValueError(clause)
+        return ids
+
+
+class FluidDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the requests to the fake FluidDB.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # send each response in one go rather than falling foul of Nagle's
+    # algorithm and delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, result=None):
+        """
+        Sends the response, JSON encoding any result.
+        """
+        body = ''
+        self.send_response(status)
+        if result is not None:
+            body = json.dumps(result)
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+        return len(body)
+
+    def handle_request(self, method):
+        """
+        Dispatches the request to the method for the endpoint and counts it.
+        """
+        state = self.server.state
+        url = urlparse.urlparse(self.path)
+        path = [urlparse.unquote(p) for p in url.path.split('/')[1:]]
+        args = urlparse.parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        endpoint = path[0]
+        if state.latency:
+            time.sleep(state.latency)
+        if endpoint != '_stats' and random.random() < state.errorRate:
+            sent = self.respond(503)
+        else:
+            handler = getattr(self, '%s_%s' % (method, endpoint.strip('_')),
+                None)
+            if handler is None:
+                sent = self.respond(404)
+            else:
+                state.lock.acquire()
+                try:
+                    try:
+                        data = body and json.loads(body) or None
+                        status, result = handler(state, path[1:], args, data)
+                    except (KeyError, ValueError, AttributeError):
+                        status, result = 400, None
+                finally:
+                    state.lock.release()
+                sent = self.respond(status, result)
+        if endpoint != '_stats':
+            state.count(method, endpoint, length, sent)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def GET_stats(self, state, path, args, data):
+        return 200, {'requests': state.stats, 'bytesIn': state.bytesIn,
+            'bytesOut': state.bytesOut}
+
+    def create(self, state, existing, parent, data):
+        path = '/'.join(parent + [data['name']])
+        if not state.exists('/'.join(parent)):
+            return 404, None
+        if path in existing:
+            return 412, None
+        existing.add(path)
+        return 201, {'id': str(uuid.uuid4()), 'URI': path}
+
+    def POST_namespaces(self, state, path, args, data):
+        return self.create(state, state.namespaces, path, data)
+
+    def POST_tags(self, state, path, args, data):
+        return self.create(state, state.tags, path, data)
+
+    def GET_namespaces(self, state, path, args, data):
+        namespace = '/'.join(path)
+        if not state.exists(namespace):
+            return 404, None
+        prefix = namespace + '/'
+        children = lambda names: [name[len(prefix):] for name in names
+            if name.startswith(prefix) and '/' not in name[len(prefix):]]
+        return 200, {'tagNames': children(state.tags),
+            'namespaceNames': children(state.namespaces)}
+
+    def GET_tags(self, state, path, args, data):
+        return '/'.join(path) in state.tags and 200 or 404, None
+
+    def DELETE_namespaces(self, state, path, args, data):
+        state.namespaces.discard('/'.join(path))
+        return 204, None
+
+    def DELETE_tags(self, state, path, args, data):
+        state.tags.discard('/'.join(path))
+        return 204, None
+
+    def POST_objects(self, state, path, args, data):
+        about = data.get('about')
+        id = state.objects.setdefault(about, str(uuid.uuid4()))
+        return 201, {'id': id, 'URI': '/objects/%s' % id}
+
+    def GET_objects(self, state, path, args, data):
+        return 200, {'ids': list(state.query(args['query'][0]))}
+
+    def PUT_values(self, state, path, args, data):
+        if 'query' in args:
+            queries = [(args['query'][0], data)]
+        else:
+            # values for several queries at once
+            queries = data['queries']
+        for query, values in queries:
+            for id in state.query(query):
+                for tag, value in values.iteritems():
+                    # setting a value on a missing tag creates it
+                    state.tags.add(tag)
+                    state.values[(id, tag)] = value['value']
+        return 204, None
+
+    def DELETE_values(self, state, path, args, data):
+        for id in state.query(args['query'][0]):
+            for tag in args.get('tag', []):
+                state.values.pop((id, tag), None)
+        return 204, None
+
+
+class FakeFluidDB(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded HTTP server emulating FluidDB. Use start() to serve requests
+    from a background thread and stop() to shut it down again. The url
+    attribute is suitable for use as the delicious2fluid instance.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, errorRate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+            FluidDBHandler)
+        self.state = FluidDBState(latency, errorRate)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.connections = set()
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+            client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops serving and closes any kept-alive connections so their handler
+        threads finish.
+        """
+        self.shutdown()
+        self.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', type='int', default=8000,
+        help='port to listen on [default: %default]')
+    parser.add_option('-l', '--latency', type='float', default=0.0,
+        help='seconds to delay each response by [default: %default]')
+    parser.add_option('-e', '--error-rate', type='float', default=0.0,
+        dest='errorRate', help='proportion of requests that fail with a 503'
+        ' [default: %default]')
+    options, args = parser.parse_args(argv)
+    server = FakeFluidDB(options.port, options.latency, options.errorRate)
+    print('Fake FluidDB listening on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,21 @@
+import bench
+import bz2
 import delicious2fluid
+import fakefluiddb
+import gzip
+import httplib2
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 import uuid
 import unittest
+import threading
+import time
 
 
 # Generic test user created on the FluidDB Sandbox for the express purpose of
@@ -39,6 +54,547 @@ class TestDelicious2Fluid(unittest.TestCase):
             self.assertTrue(attribute in objs[0])
         self.assertTrue(isinstance(objs[0]['tag'], list))
 
+    def testConnectionPool(self):
+        """
+        Ensures the pool hands back released clients rather than creating new
+        ones and never creates more than its size.
+        """
+        pool = delicious2fluid.ConnectionPool(size=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertNotEqual(first, second)
+        pool.release(first)
+        # the idle client is reused
+        self.assertEquals(first, pool.acquire())
+        pool.release(first)
+        pool.release(second)
+        self.assertEquals(2, pool._created)
+
+    def testRunConcurrently(self):
+        """
+        Makes sure every item is processed by the worker threads, failures are
+        not counted and no more than maxInFlight items are outstanding. Errors
+        that aren't just down to the network stop the run.
+        """
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0, 'seen': []}
+
+        def work(item):
+            lock.acquire()
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            state['seen'].append(item)
+            lock.release()
+            time.sleep(0.01)
+            lock.acquire()
+            state['active'] -= 1
+            lock.release()
+            if item == 3:
+                raise socket.error('reset')
+            if item == 30:
+                raise httplib2.ServerNotFoundError('x')
+        done = delicious2fluid.runConcurrently(work, xrange(20), workers=4,
+            maxInFlight=4)
+        self.assertEquals(19, done)
+        self.assertEquals(range(20), sorted(state['seen']))
+        self.assertTrue(state['peak'] <= 4)
+        # no more items are taken once the host can't be found
+        del state['seen'][:]
+        for workers in [1, 4]:
+            self.assertRaises(httplib2.ServerNotFoundError,
+                delicious2fluid.runConcurrently, work, xrange(30, 1000),
+                workers=workers, maxInFlight=4)
+            self.assertTrue(len(state['seen']) < 10)
+
+    def testRetry(self):
+        """
+        Ensures requests are retried when the server pushes back, that the
+        rate limiter slows down and that requests are eventually dropped.
+        """
+        statuses = ['503', '429', '200']
+
+        class FakePool(object):
+
+            def request(self, url, method, body, headers):
+                status = statuses.pop(0)
+                if isinstance(status, Exception):
+                    raise status
+                return httplib2.Response({'status': status}), ''
+        oldPool = delicious2fluid.pool
+        oldPolicy = delicious2fluid.retryPolicy
+        delicious2fluid.pool = FakePool()
+        delicious2fluid.retryPolicy = delicious2fluid.RetryPolicy(
+            maxRetries=2, baseDelay=0.001)
+        limiter = delicious2fluid.RateLimiter(1000)
+        try:
+            response, content = delicious2fluid.request('http://x/', 'GET',
+                limiter=limiter)
+            self.assertEquals(200, response.status)
+            self.assertEquals(2, delicious2fluid.retryPolicy.retries)
+            self.assertEquals(2, limiter.throttled)
+            self.assertTrue(limiter.rate < 1000)
+            # run out of retries
+            statuses.extend(['500', '500', '500', '200'])
+            response, content = delicious2fluid.request('http://x/')
+            self.assertEquals(500, response.status)
+            self.assertEquals(1, delicious2fluid.retryPolicy.drops)
+            # a dropped connection is retried but an unknown host isn't
+            statuses[:] = [socket.error('reset'), '200',
+                httplib2.ServerNotFoundError('x')]
+            response, content = delicious2fluid.request('http://x/')
+            self.assertEquals(200, response.status)
+            self.assertEquals(5, delicious2fluid.retryPolicy.retries)
+            self.assertRaises(httplib2.ServerNotFoundError,
+                delicious2fluid.request, 'http://x/')
+            self.assertEquals(5, delicious2fluid.retryPolicy.retries)
+        finally:
+            delicious2fluid.pool = oldPool
+            delicious2fluid.retryPolicy = oldPolicy
+
+    def testRetryDelay(self):
+        """
+        Checks the backoff delay grows exponentially (with jitter), is capped
+        and respects the Retry-After header.
+        """
+        policy = delicious2fluid.RetryPolicy(baseDelay=1, maxDelay=5)
+        for attempt in range(10):
+            delay = policy.delay(attempt)
+            self.assertTrue(0 <= delay <= min(5, 2 ** attempt))
+        response = httplib2.Response({'status': '503', 'retry-after': '3'})
+        self.assertEquals(3, policy.delay(0, response))
+
+    def testRateLimiter(self):
+        """
+        Makes sure the token bucket limits the request rate.
+        """
+        limiter = delicious2fluid.RateLimiter(100)
+        start = time.time()
+        for i in range(11):
+            limiter.acquire()
+        self.assertTrue(time.time() - start >= 0.09)
+        limiter.backoff()
+        self.assertEquals(50, limiter.rate)
+        limiter.success()
+        self.assertEquals(51, limiter.rate)
+
+    def testMetrics(self):
+        """
+        Checks phases are timed and requests are grouped by endpoint with a
+        latency histogram.
+        """
+        metrics = delicious2fluid.Metrics()
+        with metrics.phase('tags'):
+            time.sleep(0.01)
+        self.assertEquals([1, 2], list(metrics.timed('parse', [1, 2])))
+        metrics.record('POST', delicious2fluid.SANDBOX + '/objects', 201,
+            0.02, 10, 20)
+        metrics.record('POST', delicious2fluid.SANDBOX + '/objects/x', 503,
+            20, 10, 0)
+        metrics.record('GET', 'https://api.del.icio.us/v1/posts/all', None,
+            0.001, 0, 0)
+        report = metrics.report()
+        self.assertTrue(report['phases']['tags'] >= 0.01)
+        self.assertTrue('parse' in report['phases'])
+        objects = report['endpoints']['POST /objects']
+        self.assertEquals(2, objects['count'])
+        self.assertEquals({'201': 1, '503': 1}, objects['statuses'])
+        self.assertEquals({'0.025': 1, 'inf': 1}, objects['latency'])
+        self.assertEquals(20, report['bytesSent'])
+        self.assertEquals(1,
+            report['endpoints']['GET api.del.icio.us']['count'])
+        self.assertEquals(5, len(metrics.summary()))
+
+    def testProfiler(self):
+        """
+        Ensures each phase, including the threads it starts, is profiled
+        into a report and statistics file of its own.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = delicious2fluid.Profiler(directory)
+            with profiler.phase('parse'):
+                with profiler.phase('nested'):
+                    thread = threading.Thread(target=delicious2fluid.parseXml,
+                        args=(open('bookmarks.xml').read(), ))
+                    thread.start()
+                    thread.join()
+            with profiler.phase('parse'):
+                pass
+            self.assertEquals(['parse-2.prof', 'parse-2.txt', 'parse.prof',
+                'parse.txt'], sorted(os.listdir(directory)))
+            report = open(os.path.join(directory, 'parse.txt')).read()
+            self.assertTrue('Profiled 2 threads' in report)
+            self.assertTrue('iterParseXml' in report)
+            self.assertTrue('Live objects that grew the most' in report)
+        finally:
+            shutil.rmtree(directory)
+
+    def testProgress(self):
+        """
+        Ensures progress is counted against the total given by the export,
+        with skipped and failed objects accounted for, and written to the
+        status file.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'status.json')
+        delicious2fluid.progress = delicious2fluid.Progress(interval=0,
+            path=path)
+        try:
+            objs = list(delicious2fluid.iterParseXml(
+                open('bookmarks.xml', 'r')))
+            progress = delicious2fluid.progress
+            progress.record('objects')
+            progress.record('objects', False)
+            stats = progress.stats('objects')
+            self.assertEquals(10, stats['total'])
+            self.assertEquals(1, stats['skipped'])
+            self.assertEquals(3, stats['completed'])
+            self.assertEquals(0.5, stats['errorRate'])
+            self.assertTrue(stats['perSecond'] > 0)
+            self.assertTrue(stats['eta'] is not None)
+            self.assertTrue(progress.summary('objects').startswith(
+                'objects: 3/10 (30.0%)'))
+            progress.name = 'alice'
+            self.assertTrue(progress.summary('objects').startswith(
+                'alice objects: 3/10'))
+            status = json.load(open(path))
+            self.assertEquals(3, status['progress']['objects']['completed'])
+        finally:
+            delicious2fluid.progress = None
+            shutil.rmtree(directory)
+
+    def testIterParseXml(self):
+        """
+        Makes sure the streaming parser yields the object dicts one at a time
+        and collects the tags incrementally.
+        """
+        data = open('bookmarks.xml', 'r')
+        tags = set()
+        objs = delicious2fluid.iterParseXml(data, tags)
+        # Nothing has been parsed yet
+        self.assertEquals(0, len(tags))
+        first = objs.next()
+        self.assertEquals('http://cassandra.apache.org/', first['href'])
+        self.assertEquals('The Apache Cassandra Project', first['title'])
+        self.assertEquals(['foo', 'bar', 'baz'], first['tag'])
+        self.assertEquals(set(['foo', 'bar', 'baz']), tags)
+        # The remaining shared bookmarks (one was ignored)
+        self.assertEquals(9, len(list(objs)))
+        data.close()
+
+    def testBookmark(self):
+        """
+        Bookmarks behave like the dicts they replace, share their tag names
+        and have their tag paths built just once per namespace.
+        """
+        tags, objs = delicious2fluid.parseXml(open('bookmarks.xml').read())
+        bookmark = objs[0]
+        self.assertTrue(isinstance(bookmark, delicious2fluid.Bookmark))
+        self.assertFalse(hasattr(bookmark, '__dict__'))
+        self.assertEquals(bookmark.title, bookmark['title'])
+        self.assertEquals(None, bookmark.get('shared'))
+        self.assertFalse('shared' in bookmark)
+        self.assertFalse('shared' in bookmark.keys())
+        self.assertRaises(KeyError, lambda: bookmark['shared'])
+        self.assertRaises(KeyError, lambda: bookmark['foo'])
+        bookmark['meta'] = 'changed'
+        self.assertEquals('changed', bookmark['meta'])
+        # the same tag on different bookmarks is the same string
+        names = {}
+        for obj in objs:
+            for name in obj['tag']:
+                self.assertTrue(names.setdefault(name, name) is name)
+        # but nothing outlives the parse holding on to the notes
+        export = '<posts>%s</posts>' % ''.join(['<post href="%d" tag="a" '
+            'extended="note %d" />' % (i, i) for i in range(100)])
+        for obj in list(delicious2fluid.iterParseXml(export)):
+            # referred to by the bookmark and getrefcount's argument alone
+            self.assertEquals(2, sys.getrefcount(obj.notes))
+        paths = delicious2fluid.tagPaths('test/delicious')
+        self.assertTrue(paths is delicious2fluid.tagPaths('test/delicious'))
+        self.assertEquals('test/delicious/title', paths.field('title'))
+        self.assertEquals('test/delicious/delicious/meta', paths.field('meta'))
+        self.assertEquals('test/delicious/foo', paths.tag('foo'))
+        self.assertTrue(paths.tag('foo') is paths.tag('foo'))
+
+    def testValueBatcher(self):
+        """
+        Checks the values of objects are batched together and batches are
+        sent when full, when the queries get too long and when flushed.
+        """
+        sent = []
+        batcher = delicious2fluid.ValueBatcher(batchSize=2,
+            maxQueryLength=60)
+        batcher.put = lambda batch: sent.append([query
+            for query, values, key in batch])
+        for about in ['a', 'b', 'c']:
+            batcher.add(delicious2fluid.aboutQuery(about), {}, about)
+        # the first batch was full
+        self.assertEquals([['fluiddb/about="a"', 'fluiddb/about="b"']], sent)
+        # the queries would be too long
+        batcher.add(delicious2fluid.aboutQuery('x' * 40), {}, 'x')
+        self.assertEquals(['fluiddb/about="c"'], sent[1])
+        batcher.flush()
+        self.assertEquals(3, len(sent))
+        self.assertEquals([], batcher._batch)
+
+    def testMergeBookmarks(self):
+        """
+        Makes sure bookmarks of the same URL are merged into one with all
+        their tags and the fields picked by the policy.
+        """
+        def bookmarks():
+            return [
+                delicious2fluid.Bookmark('http://a/', 'a1', 'old', ['foo'],
+                    '2010-01-01T00:00:00Z'),
+                delicious2fluid.Bookmark('http://b/', 'b', 'b', ['bar'],
+                    '2010-01-01T00:00:00Z'),
+                delicious2fluid.Bookmark('http://a/', 'a2', 'new',
+                    ['bar', 'foo'], '2010-06-01T00:00:00Z'),
+                delicious2fluid.Bookmark('http://a/', 'a3', 'last', ['baz'],
+                    '2010-03-01T00:00:00Z'),
+            ]
+        merged = list(delicious2fluid.mergeBookmarks(bookmarks()))
+        self.assertEquals(['http://a/', 'http://b/'],
+            [obj['href'] for obj in merged])
+        self.assertEquals('new', merged[0]['title'])
+        self.assertEquals(['foo', 'bar', 'baz'], merged[0]['tag'])
+        self.assertEquals(['bar'], merged[1]['tag'])
+        first = list(delicious2fluid.mergeBookmarks(bookmarks(),
+            policy='first'))
+        self.assertEquals('old', first[0]['title'])
+        last = list(delicious2fluid.mergeBookmarks(bookmarks(),
+            policy='last'))
+        self.assertEquals('last', last[0]['title'])
+        self.assertEquals(['foo', 'bar', 'baz'], last[0]['tag'])
+        self.assertRaises(ValueError, list,
+            delicious2fluid.mergeBookmarks(bookmarks(), policy='random'))
+
+    def testJournal(self):
+        """
+        Ensures recorded work survives a restart when resuming and is
+        forgotten when not.
+        """
+        path = tempfile.mktemp()
+        try:
+            journal = delicious2fluid.Journal(path)
+            journal.record('namespace', 'test/delicious')
+            journal.record('object', 'abc')
+            journal.record('object', 'abc')
+            self.assertTrue(journal.done('object', 'abc'))
+            self.assertFalse(journal.done('tag', 'abc'))
+            journal.close()
+            # simulate an entry torn by a crash
+            data = open(path, 'a')
+            data.write('["object", "de')
+            data.close()
+            journal = delicious2fluid.Journal(path, resume=True)
+            self.assertEquals(2, len(journal))
+            self.assertTrue(journal.done('namespace', 'test/delicious'))
+            journal.record('tag', 'test/foo')
+            journal.close()
+            journal = delicious2fluid.Journal(path, resume=True)
+            self.assertTrue(journal.done('tag', 'test/foo'))
+            journal.close()
+            journal = delicious2fluid.Journal(path)
+            self.assertEquals(0, len(journal))
+            journal.close()
+        finally:
+            os.remove(path)
+
+    def testSyncIndex(self):
+        """
+        Checks only new or changed bookmarks are yielded on the next sync and
+        that deleted bookmarks are spotted.
+        """
+        path = tempfile.mktemp()
+        try:
+            tags, objs = delicious2fluid.parseXml(open('bookmarks.xml').read())
+            index = delicious2fluid.SyncIndex(path)
+            # everything is new the first time around
+            self.assertEquals(10, len(list(index.changed(objs))))
+            index.commit()
+            index.save()
+            # edit one bookmark and delete another
+            objs[0]['meta'] = 'edited'
+            deleted = objs.pop()
+            index = delicious2fluid.SyncIndex(path)
+            changed = list(index.changed(objs))
+            self.assertEquals([objs[0]], changed)
+            self.assertEquals([deleted['href']], index.deleted().keys())
+            # objects the journal doesn't record as imported aren't committed
+            journal = delicious2fluid.Journal(path + '.journal')
+            index.commit(journal)
+            journal.close()
+            os.remove(path + '.journal')
+            self.assertNotEquals('edited', index.entries[objs[0]['href']][1])
+        finally:
+            os.remove(path)
+
+    def testExistenceCache(self):
+        """
+        Makes sure the on-disk cache is loaded (ignoring expired namespaces),
+        answers without going to FluidDB and is saved again, and that failed
+        lookups aren't repeated.
+        """
+        path = tempfile.mktemp()
+        try:
+            data = open(path, 'w')
+            json.dump({
+                'test': {'time': time.time(), 'tags': ['foo'],
+                    'namespaces': ['delicious']},
+                'old': {'time': time.time() - 120, 'tags': ['bar'],
+                    'namespaces': []},
+            }, data)
+            data.close()
+            cache = delicious2fluid.ExistenceCache(path, ttl=60)
+            self.assertTrue(cache.hasTag('test', 'foo'))
+            self.assertFalse(cache.hasTag('test', 'bar'))
+            self.assertTrue(cache.hasNamespace('test', 'delicious'))
+            self.assertFalse('old' in cache._namespaces)
+            # new namespaces are known to be empty
+            cache.addNamespace('test', 'new')
+            self.assertFalse(cache.hasTag('test/new', 'foo'))
+            cache.addTag('test/new', 'foo')
+            self.assertEquals(0, cache.lookups)
+            cache.save()
+            cache = delicious2fluid.ExistenceCache(path, ttl=60)
+            self.assertTrue(cache.hasNamespace('test', 'new'))
+            self.assertTrue(cache.hasTag('test/new', 'foo'))
+        finally:
+            os.remove(path)
+        # a namespace that can't be listed is only asked about once
+
+        class Backend(delicious2fluid.FluidDBBackend):
+
+            def listNamespace(self, namespace):
+                return httplib2.Response({'status': '401'}), None
+        cache = delicious2fluid.ExistenceCache()
+        delicious2fluid.backend = Backend()
+        try:
+            self.assertFalse(cache.hasTag('test', 'foo'))
+            self.assertFalse(cache.hasTag('test', 'bar'))
+            self.assertFalse(cache.hasNamespace('test', 'delicious'))
+        finally:
+            delicious2fluid.backend = delicious2fluid.FluidDBBackend()
+        self.assertEquals(1, cache.lookups)
+
+    def testAsyncHandler(self):
+        """
+        Ensures records are written by the background thread, errors and
+        flushes wait for them to be written and sampling drops all but one in
+        every so many objects, along with every message about them.
+        """
+        written = []
+        target = logging.Handler()
+        target.emit = lambda record: written.append(record.getMessage())
+        handler = delicious2fluid.AsyncHandler(target)
+        log = logging.getLogger('d2f.test.%s' % uuid.uuid4())
+        log.propagate = False
+        log.addHandler(handler)
+        sampler = delicious2fluid.SampleFilter(every=3)
+        log.addFilter(sampler)
+        for i in range(6):
+            sampler.sample()
+            log.info('message %d', i)
+            log.debug('response %d', i)
+        log.error('failed')
+        self.assertEquals(['message 0', 'response 0', 'message 3',
+            'response 3', 'failed'], written)
+        sampler.every = 1
+        log.debug('%r', {'status': '200'})
+        handler.flush()
+        self.assertEquals("{'status': '200'}", written[-1])
+
+    def testLazyImports(self):
+        """
+        Makes sure importing the module doesn't import the HTTP machinery or
+        create the log file until they're needed.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            script = ('import sys, delicious2fluid;'
+                ' print("httplib2" in sys.modules)')
+            output = subprocess.Popen([sys.executable, '-c', script],
+                cwd=directory, stdout=subprocess.PIPE,
+                env=dict(os.environ, PYTHONPATH=os.path.abspath('.')),
+                ).communicate()[0]
+            self.assertEquals('False', output.strip())
+            self.assertEquals([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def testLRUCache(self):
+        """
+        Ensures values are computed once, counted as hits and misses and that
+        the least recently used are dropped once the cache is full.
+        """
+        cache = delicious2fluid.LRUCache(maxSize=4)
+        computed = []
+        compute = lambda key: computed.append(key) or key.upper()
+        for key in ['a', 'b', 'a', 'c', 'd', 'a', 'e']:
+            cache.get(key, compute)
+        self.assertEquals(['a', 'b', 'c', 'd', 'e'], computed)
+        self.assertEquals((2, 5), (cache.hits, cache.misses))
+        # b and c were least recently used
+        self.assertEquals(3, len(cache))
+        self.assertEquals('A', cache.get('a', compute))
+        cache.get('b', compute)
+        self.assertEquals(['a', 'b', 'c', 'd', 'e', 'b'], computed)
+        # build_url caches the quoted paths
+        before = delicious2fluid.urlCache.hits
+        url = delicious2fluid.build_url(['tags', 'a b', 'c/d'])
+        self.assertEquals(delicious2fluid.instance + '/tags/a%20b/c%2Fd', url)
+        self.assertEquals(url,
+            delicious2fluid.build_url(['tags', 'a b', 'c/d']))
+        self.assertEquals(before + 1, delicious2fluid.urlCache.hits)
+
+    def testAboutQuery(self):
+        """
+        Make sure quotes in about values are escaped in the query.
+        """
+        self.assertEquals('fluiddb/about="say \\"hi\\""',
+            delicious2fluid.aboutQuery('say "hi"'))
+
+    def testIterBookmarks(self):
+        """
+        Makes sure bookmarks are fetched a page at a time, no faster than
+        delicious allows, until delicious runs out of them.
+        """
+        posts = open('bookmarks.xml').read().splitlines()[2:-2]
+        requested = []
+        times = []
+
+        def getBookmarks(username, password, compress=True, start=0,
+            results=0):
+            requested.append((start, results))
+            times.append(time.time())
+            return '<posts>%s</posts>' % '\n'.join(
+                posts[start:start + results])
+        oldGetBookmarks = delicious2fluid.getBookmarks
+        oldInterval = delicious2fluid.DELICIOUS_INTERVAL
+        delicious2fluid.getBookmarks = getBookmarks
+        delicious2fluid.DELICIOUS_INTERVAL = 0.05
+        try:
+            tags = set()
+            objs = list(delicious2fluid.iterBookmarks(USERNAME, PASSWORD,
+                tags, pageSize=4))
+            self.assertEquals([(0, 4), (4, 4), (8, 4)], requested)
+            self.assertTrue(times[1] - times[0] >= 0.05)
+            self.assertTrue(times[2] - times[1] >= 0.05)
+            # the private bookmark counts towards filling a page
+            del requested[:]
+            list(delicious2fluid.iterBookmarks(USERNAME, PASSWORD,
+                pageSize=11))
+            self.assertEquals([(0, 11), (11, 11)], requested)
+        finally:
+            delicious2fluid.getBookmarks = oldGetBookmarks
+            delicious2fluid.DELICIOUS_INTERVAL = oldInterval
+        # the private bookmark is ignored
+        self.assertEquals(10, len(objs))
+        self.assertEquals('http://cassandra.apache.org/', objs[0]['href'])
+        self.assertEquals(set(['foo', 'bar', 'baz']), tags)
+
     def testCreateNamespace(self):
         """
         Check that the recursive function works correctly to generate a set of
@@ -185,3 +741,274 @@ class TestDelicious2Fluid(unittest.TestCase):
                     '/tags/test/%s/%s' % (unique_ns, tag))
             delicious2fluid.call('DELETE',
                     '/namespaces/test/%s' % unique_ns)
+
+
+class TestWithFakeFluidDB(unittest.TestCase):
+    """
+    Tests that run against the local stand-in for FluidDB in fakefluiddb.py
+    rather than the sandbox.
+    """
+
+    def setUp(self):
+        self.server = fakefluiddb.FakeFluidDB().start()
+        self.instance = delicious2fluid.instance
+        delicious2fluid.instance = self.server.url
+        delicious2fluid.logout()
+
+    def tearDown(self):
+        delicious2fluid.instance = self.instance
+        self.server.stop()
+
+    def testImportIntoFluidDB(self):
+        """
+        Ensures a concurrent, batched import creates and tags all the
+        objects.
+        """
+        tags, objects = delicious2fluid.parseXml(open('bookmarks.xml').read())
+        delicious2fluid.importIntoFluidDB(tags, objects, USERNAME, PASSWORD,
+            'test/bookmarks', workers=4, batchSize=3)
+        for tag in ['foo', 'bar', 'baz', 'title', 'notes', 'delicious/meta']:
+            headers, result = delicious2fluid.call('GET', '/objects',
+                query='has test/bookmarks/%s' % tag)
+            self.assertEquals(10, len(result['ids']))
+        headers, result = delicious2fluid.call('GET',
+            '/namespaces/test/bookmarks/delicious', returnTags=True,
+            returnNamespaces=True)
+        self.assertEquals(set(['hash', 'tag', 'time', 'meta']),
+            set(result['tagNames']))
+        # four batches (of 3, 3, 3 and 1 objects) instead of a PUT per object
+        stats = self.server.state.stats
+        self.assertEquals(10, stats['POST /objects'])
+        self.assertEquals(4, stats['PUT /values'])
+        headers, result = delicious2fluid.call('GET', '/objects',
+            query='fluiddb/about="http://cassandra.apache.org/"')
+        tag = self.server.state.values[(result['ids'][0],
+            'test/bookmarks/delicious/tag')]
+        self.assertEquals(['foo', 'bar', 'baz'], tag)
+
+    def testFailedBatches(self):
+        """
+        Makes sure objects whose batch is rejected are counted as failures
+        rather than imports.
+        """
+
+        class Backend(delicious2fluid.FluidDBBackend):
+
+            def setBatchValues(self, queries):
+                return httplib2.Response({'status': '500'}), None
+        tags, objects = delicious2fluid.parseXml(open('bookmarks.xml').read())
+        delicious2fluid.backend = Backend()
+        delicious2fluid.progress = delicious2fluid.Progress()
+        try:
+            count = delicious2fluid.importIntoFluidDB(tags, objects, USERNAME,
+                PASSWORD, 'test/failed', workers=2, batchSize=5)
+            stats = delicious2fluid.progress.stats('objects')
+        finally:
+            delicious2fluid.backend = delicious2fluid.FluidDBBackend()
+            delicious2fluid.progress = None
+        self.assertEquals(0, count)
+        self.assertEquals(0, stats['imported'])
+        self.assertEquals(10, stats['failed'])
+
+    def testProvisionConcurrently(self):
+        """
+        Checks a tree of namespaces is created level by level and tags are
+        created concurrently, skipping those that already exist.
+        """
+        delicious2fluid.login(USERNAME, PASSWORD)
+        delicious2fluid.createNamespaces('test', [['tree', 'a'],
+            ['tree', 'b', 'c'], ['other']], workers=4)
+        self.assertEquals(set(['test/tree', 'test/tree/a', 'test/tree/b',
+            'test/tree/b/c', 'test/other']), self.server.state.namespaces)
+        tags = set(['tag%d' % i for i in range(50)])
+        cache = delicious2fluid.ExistenceCache()
+        posts = lambda: delicious2fluid.metrics.endpoints.get('POST /tags',
+            {}).get('count', 0)
+        before = posts()
+        delicious2fluid.createTags(tags, 'test/tree', cache=cache, workers=8)
+        self.assertEquals(set(['test/tree/%s' % tag for tag in tags]),
+            self.server.state.tags)
+        delicious2fluid.createTags(tags | set(['new']), 'test/tree',
+            cache=cache, workers=8)
+        self.assertTrue('test/tree/new' in self.server.state.tags)
+        self.assertEquals(before + 51, posts())
+        self.assertEquals(1, cache.lookups)
+
+    def testDryRun(self):
+        """
+        Makes sure a dry run plans the requests without making them and, when
+        diffing, only plans to create what's missing.
+        """
+        tags, objects = delicious2fluid.parseXml(open('bookmarks.xml').read())
+        delicious2fluid.planner = delicious2fluid.Planner()
+        try:
+            delicious2fluid.importIntoFluidDB(tags, objects, USERNAME,
+                PASSWORD, 'test/plan', cache=delicious2fluid.ExistenceCache())
+            self.assertEquals({}, self.server.state.stats)
+            report = delicious2fluid.planner.report(rate=10)
+            endpoints = report['endpoints']
+            self.assertEquals(2, endpoints['POST /namespaces']['count'])
+            self.assertEquals(9, endpoints['POST /tags']['count'])
+            self.assertEquals(10, endpoints['POST /objects']['count'])
+            self.assertEquals(10, endpoints['PUT /values']['count'])
+            self.assertTrue(endpoints['PUT /values']['bytesSent'] > 0)
+            self.assertEquals(report['requests'] / 10.0, report['seconds'])
+            # once the tags exist only the objects are left to plan
+            delicious2fluid.planner = None
+            delicious2fluid.importIntoFluidDB(tags, objects, USERNAME,
+                PASSWORD, 'test/plan')
+            delicious2fluid.planner = delicious2fluid.Planner(diff=True)
+            delicious2fluid.importIntoFluidDB(tags, objects, USERNAME,
+                PASSWORD, 'test/plan', cache=delicious2fluid.ExistenceCache())
+            endpoints = delicious2fluid.planner.report()['endpoints']
+            self.assertFalse('POST /namespaces' in endpoints)
+            self.assertFalse('POST /tags' in endpoints)
+            self.assertEquals(10, endpoints['POST /objects']['count'])
+        finally:
+            delicious2fluid.planner = None
+
+    def testLocalSink(self):
+        """
+        Ensures an import staged in a local sink writes nothing to FluidDB and
+        can be replayed to it afterwards.
+        """
+        path = tempfile.mktemp()
+        tags, objects = delicious2fluid.parseXml(open('bookmarks.xml').read())
+        delicious2fluid.backend = delicious2fluid.LocalSink(path, batchSize=7)
+        try:
+            delicious2fluid.importIntoFluidDB(tags, objects, USERNAME,
+                PASSWORD, 'test/staged', batchSize=3,
+                cache=delicious2fluid.ExistenceCache())
+            delicious2fluid.backend.close()
+            self.assertEquals({}, self.server.state.stats)
+            operations = list(delicious2fluid.readSink(path))
+            self.assertEquals(delicious2fluid.backend.operations,
+                len(operations))
+            self.assertEquals(('namespace', ['test', 'staged',
+                'Holds tags imported from delicious']), operations[0])
+            # a torn batch is ignored, even the operations written in full
+            sink = open(path, 'a')
+            sink.write('["object", "http://example.com/torn"]\n'
+                '["object", "http://exam')
+            sink.close()
+            self.assertEquals(operations, list(delicious2fluid.readSink(path)))
+            delicious2fluid.backend = delicious2fluid.FluidDBBackend()
+            replayed = delicious2fluid.replay(path, workers=4)
+            self.assertEquals({'namespace': 2, 'tag': 9, 'object': 10,
+                'values': 0, 'batch': 4, 'remove': 0}, replayed)
+            for tag in ['foo', 'title', 'delicious/meta']:
+                headers, result = delicious2fluid.call('GET', '/objects',
+                    query='has test/staged/%s' % tag)
+                self.assertEquals(10, len(result['ids']))
+        finally:
+            delicious2fluid.backend = delicious2fluid.FluidDBBackend()
+            os.remove(path)
+
+    def testDefaultImportStreams(self):
+        """
+        Makes sure that, by default, objects are imported whilst the export
+        is still being read rather than after all of it has been.
+        """
+        self.assertEquals('none', delicious2fluid.parseArgs([])[0].merge)
+        state = {'read': 0, 'first': None}
+
+        def iterFiles(paths, tags=None):
+            for obj in delicious2fluid.parseXml(
+                open('bookmarks.xml').read())[1]:
+                state['read'] += 1
+                yield obj
+
+        class Backend(delicious2fluid.FluidDBBackend):
+
+            def createObject(self, about):
+                if state['first'] is None:
+                    state['first'] = state['read']
+                return delicious2fluid.FluidDBBackend.createObject(self,
+                    about)
+        oldIterFiles = delicious2fluid.iterFiles
+        delicious2fluid.iterFiles = iterFiles
+        delicious2fluid.backend = Backend()
+        path = tempfile.mktemp()
+        try:
+            result = delicious2fluid.migrateAccount(({'fluiddbUser': USERNAME,
+                'fluiddbPassword': PASSWORD, 'fluiddbRoot': 'test/stream',
+                'files': ['bookmarks.xml'], 'journal': path},
+                {'instance': self.server.url}))
+        finally:
+            delicious2fluid.iterFiles = oldIterFiles
+            delicious2fluid.backend = delicious2fluid.FluidDBBackend()
+            delicious2fluid.progress = None
+            os.remove(path)
+        self.assertEquals(None, result['error'])
+        self.assertEquals(10, result['objects'])
+        self.assertTrue(state['first'] < 10)
+
+    def testImportFiles(self):
+        """
+        Checks bookmarks are imported from plain, gzip and bzip2 compressed
+        export files.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            posts = open('bookmarks.xml').read().splitlines()
+            paths = [os.path.join(directory, name)
+                for name in ['plain.xml', 'export.xml.gz', 'export.bz2']]
+            for path, opener, start, end in zip(paths,
+                [open, gzip.open, bz2.BZ2File], [2, 6, 10], [6, 10, 13]):
+                export = opener(path, 'wb')
+                export.write('\n'.join(posts[:2] + posts[start:end] +
+                    posts[-2:]))
+                export.close()
+            self.assertEquals(10, delicious2fluid.importFiles(paths,
+                USERNAME, PASSWORD, 'test/files'))
+            headers, result = delicious2fluid.call('GET', '/objects',
+                query='has test/files/title')
+            self.assertEquals(10, len(result['ids']))
+        finally:
+            shutil.rmtree(directory)
+
+    def testMigrateAccounts(self):
+        """
+        Ensures many accounts are migrated in worker processes and failures
+        are reported rather than stopping the others.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            accounts = []
+            for name in ['a', 'b', 'c']:
+                accounts.append({'name': name, 'fluiddbUser': USERNAME,
+                    'fluiddbPassword': PASSWORD,
+                    'fluiddbRoot': 'test/%s' % name,
+                    'files': ['bookmarks.xml'],
+                    'journal': os.path.join(directory, name)})
+            accounts[2]['files'] = [os.path.join(directory, 'missing.xml')]
+            results = delicious2fluid.migrateAccounts(accounts, processes=2,
+                instance=self.server.url, workers=2)
+            results = dict((result['account'], result) for result in results)
+            self.assertEquals(10, results['a']['objects'])
+            self.assertEquals(10, results['b']['objects'])
+            self.assertTrue(results['c']['error'])
+            # each account's progress is tracked on its own
+            self.assertEquals(10,
+                results['a']['progress']['objects']['imported'])
+            for name in ['a', 'b']:
+                headers, result = delicious2fluid.call('GET', '/objects',
+                    query='has test/%s/title' % name)
+                self.assertEquals(10, len(result['ids']))
+        finally:
+            shutil.rmtree(directory)
+
+    def testGenerateExport(self):
+        """
+        Makes sure the benchmark's synthetic exports can be parsed.
+        """
+        path = tempfile.mktemp()
+        try:
+            bench.generateExport(path, 50, tagCount=10, tagSetCount=5)
+            tags, objects = delicious2fluid.parseXml(open(path).read())
+            self.assertEquals(50, len(objects))
+            self.assertTrue(len(tags) <= 10)
+            self.assertTrue(len(set(tuple(obj['tag']) for obj in objects))
+                <= 5)
+        finally:
+            os.remove(path)